@@ -0,0 +1,169 @@
+"""
+Microbenchmarks for the pytuya codec hot path.
+
+Usage::
+
+    python benchmarks/bench_codec.py [--number N] [--json results.json] [--compare baseline.json]
+
+Times building status and SET frames, bin2hex/hex2bin, parsing plain and encrypted status replies,
+and building a BulbDevice colour frame. AES encrypt, decrypt and building a complete signed SET
+frame are timed on every available crypto backend.
+
+--json saves the results so runs can be compared. --compare reads a saved run, prints how much
+each benchmark changed, and exits with status 1 if any got slower than --threshold allows.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytuya  # noqa: E402
+
+DEV_ID = '0123456789abcdef0123'
+LOCAL_KEY = '0123456789abcdef'
+SET_JSON = b'{"devId":"0123456789abcdef0123","uid":"0123456789abcdef0123","t":"1700000000","dps":{"1":true}}'
+STATUS_JSON = b'{"devId":"0123456789abcdef0123","dps":{"1":true,"2":0},"t":1700000000,"s":123}'
+SLOW_BACKENDS = {'pyaes': 20}  # Backends so slow the iteration count is divided by this.
+
+
+def status_replies():
+    """
+    A plain and an encrypted status reply, as decoded from the device.
+    """
+    plain = pytuya.TuyaMessage(1, 0x0a, 0, STATUS_JSON, 0)
+    encrypted = pytuya.PROTOCOL_VERSION_BYTES + b'0' * 16 + pytuya.AESCipher(LOCAL_KEY.encode('latin1')).encrypt(STATUS_JSON)
+    return plain, pytuya.TuyaMessage(1, 0x08, None, encrypted, 0)
+
+
+def codec_benchmarks():
+    """
+    The benchmarks that don't depend on the crypto backend.
+
+    :return: Dictionary of benchmark name -> function.
+    """
+    outlet = pytuya.OutletDevice(DEV_ID, '127.0.0.1', LOCAL_KEY)
+    bulb = pytuya.BulbDevice(DEV_ID, '127.0.0.1', LOCAL_KEY)
+    bulb._send_receive = lambda payload: payload  # only build the frame, don't send it
+    frame = bytes(outlet.generate_payload(pytuya.SET, {'1': True}))
+    frame_hex = pytuya.bin2hex(frame)
+    plain, encrypted = status_replies()
+    ramp = [(index, 255 - index, 127) for index in range(256)]
+
+    return {
+        'generate_payload.status': lambda: outlet.generate_payload('status'),
+        'generate_payload.set': lambda: outlet.generate_payload(pytuya.SET, {'1': True}),
+        'bin2hex': lambda: pytuya.bin2hex(frame),
+        'hex2bin': lambda: pytuya.hex2bin(frame_hex),
+        'parse_status.plain': lambda: outlet.parse_status(plain),
+        'parse_status.encrypted': lambda: outlet.parse_status(encrypted),
+        'set_colour': lambda: bulb.set_colour(255, 127, 0),
+        'colour_hexes.256': lambda: pytuya.BulbDevice.colour_hexes(ramp),
+    }
+
+
+def crypto_benchmarks():
+    """
+    Encrypt, decrypt and build a signed SET frame with the currently selected backend.
+
+    :return: Dictionary of benchmark name -> function.
+    """
+    cipher = pytuya.AESCipher(LOCAL_KEY.encode('latin1'))
+    encrypted = cipher.encrypt(STATUS_JSON)
+    outlet = pytuya.OutletDevice(DEV_ID, '127.0.0.1', LOCAL_KEY)
+    return {
+        'encrypt': lambda: cipher.encrypt(SET_JSON),
+        'decrypt': lambda: cipher.decrypt(encrypted),
+        'set_frame': lambda: outlet.generate_payload(pytuya.SET, {'1': True}),
+    }
+
+
+def time_function(function, number):
+    """
+    :return: Best of three runs, in microseconds per call.
+    """
+    return min(timeit.repeat(function, number=number, repeat=3)) / number * 1e6
+
+
+def run(number):
+    """
+    Run every benchmark.
+
+    :param number: Iterations per timing.
+    :return: Dictionary of benchmark name -> microseconds per call.
+    """
+    results = {}
+    default_backend = pytuya.BACKENDS[0].name
+    for backend in pytuya.BACKENDS:
+        pytuya.set_backend(backend.name)
+        backend_number = max(1, number // SLOW_BACKENDS.get(backend.name, 1))
+        for name, function in crypto_benchmarks().items():
+            results['aes.%s.%s' % (backend.name, name)] = time_function(function, backend_number)
+    pytuya.set_backend(default_backend)
+    for name, function in codec_benchmarks().items():
+        results[name] = time_function(function, number)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the change of every benchmark against a saved run.
+
+    :return: List of benchmark names that got slower than the threshold allows.
+    """
+    regressions = []
+    print('%-32s %12s %12s %8s' % ('benchmark', 'baseline us', 'now us', 'ratio'))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        ratio = results[name] / baseline[name]
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-32s %12.2f %12.2f %7.2fx%s' % (name, baseline[name], results[name], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--number', type=int, default=5000, help='iterations per timing')
+    parser.add_argument('--json', help='save the results to this file')
+    parser.add_argument('--compare', help='compare against results saved with --json')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='with --compare, fail if a benchmark is this many times slower')
+    args = parser.parse_args()
+
+    results = run(args.number)
+    print('%-32s %12s' % ('benchmark', 'us per call'))
+    for name in sorted(results):
+        print('%-32s %12.2f' % (name, results[name]))
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump({
+                'timestamp': int(time.time()),
+                'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'machine': platform.machine(),
+                'backends': [backend.name for backend in pytuya.BACKENDS],
+                'number': args.number,
+                'unit': 'us',
+                'results': results,
+            }, output, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        print()
+        regressions = compare(results, baseline, args.threshold)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
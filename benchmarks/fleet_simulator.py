@@ -0,0 +1,443 @@
+"""
+Load test the Tuya module against a fleet of simulated devices.
+
+Usage::
+
+    python benchmarks/fleet_simulator.py [--count 200] [--network 127.77.0.0/20] [--json results.json]
+
+Every simulated device listens on its own loopback address (Linux routes all of 127.0.0.0/8 to the
+loopback interface) and speaks the 3.1 frame format with its own devId and local_key: status,
+SET (encrypted, checked against the device's key), heartbeats, and encrypted status pushes after
+every change. Devices can be told to refuse a second connection like real ones do, answer slowly,
+push random status changes and reset connections.
+
+The module is then driven through scan_for_tuya_devices, fetch_all_device_status and
+_device_command_, and the throughput, p50/p99 latency and error rate of each phase are reported.
+This needs the Yombo gateway's python environment, since the module itself is imported, but no
+gateway is started and no hardware is needed.
+"""
+import argparse
+from base64 import b64decode
+from hashlib import md5
+import importlib
+import json
+import os
+import random
+import struct
+import sys
+import time
+from zlib import crc32
+
+from netaddr import IPNetwork
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.task import LoopingCall
+
+MODULE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(MODULE_DIR))
+module_package = importlib.import_module(os.path.basename(MODULE_DIR))
+pytuya = importlib.import_module(module_package.__name__ + '.pytuya')
+tuya = importlib.import_module(module_package.__name__ + '.tuya')
+
+STATUS = 0x0a
+SET = 0x07
+HEART_BEAT = 0x09
+PUSH = 0x08
+
+
+def build_frame(seqno, command, payload, retcode=True):
+    """
+    Build a frame the way the devices send them: header, optional return code, payload, crc32, suffix.
+    """
+    body = (b'\x00\x00\x00\x00' if retcode else b'') + payload
+    header = struct.pack(pytuya.HEADER_FORMAT, pytuya.PREFIX, seqno, command, len(body) + pytuya.FOOTER_SIZE)
+    return header + body + struct.pack(pytuya.FOOTER_FORMAT, crc32(header + body) & 0xffffffff, pytuya.SUFFIX)
+
+
+class SimulatedDeviceProtocol(Protocol):
+    """
+    One connection to a simulated device.
+    """
+    def __init__(self):
+        self.decoder = pytuya.FrameDecoder()
+
+    def connectionMade(self):
+        device = self.factory
+        device.connections_made += 1
+        if device.single_connection and len(device.clients) > 0:
+            device.refused += 1
+            self.transport.abortConnection()
+            return
+        device.clients.append(self)
+
+    def connectionLost(self, reason):
+        if self in self.factory.clients:
+            self.factory.clients.remove(self)
+
+    def dataReceived(self, data):
+        for message in self.decoder.feed(data):
+            self.factory.frame_received(self, message)
+
+
+class SimulatedDevice(Factory):
+    """
+    A single simulated Tuya device.
+
+    :param tuya_id: The devId.
+    :param local_key: The key SET frames must be encrypted with.
+    :param address: Loopback address to listen on.
+    :param single_connection: Refuse connections while one is already open, like the real devices.
+    :param delay: Average seconds before answering a request.
+    :param reset_rate: Fraction of requests answered by resetting the connection.
+    :param push_interval: Average seconds between random status changes pushed to clients, 0 for never.
+    """
+    protocol = SimulatedDeviceProtocol
+
+    def __init__(self, tuya_id, local_key, address, single_connection=True, delay=0, reset_rate=0,
+                 push_interval=0):
+        self.tuya_id = tuya_id
+        self.local_key = local_key
+        self.address = address
+        self.single_connection = single_connection
+        self.delay = delay
+        self.reset_rate = reset_rate
+        self.push_interval = push_interval
+        self.cipher = pytuya.AESCipher(local_key.encode('latin1'))
+        self.dps = {'1': False}
+        self.clients = []
+        self.port = None
+        self.pusher = None
+        self.seqno = 0
+
+        self.connections_made = 0
+        self.refused = 0
+        self.requests = 0
+        self.resets = 0
+        self.bad_key = 0
+
+    def start(self):
+        self.port = reactor.listenTCP(tuya.protocol.DEFAULT_PORT, self, interface=self.address)
+        if self.push_interval > 0:
+            self.pusher = LoopingCall(self.random_change)
+            self.pusher.start(self.push_interval * random.uniform(0.5, 1.5), now=False)
+
+    def stop(self):
+        if self.pusher is not None and self.pusher.running:
+            self.pusher.stop()
+        for client in list(self.clients):
+            client.transport.abortConnection()
+        return self.port.stopListening()
+
+    def frame_received(self, client, message):
+        self.requests += 1
+        if self.reset_rate > 0 and random.random() < self.reset_rate:
+            self.resets += 1
+            client.transport.abortConnection()
+            return
+        if self.delay > 0:
+            reactor.callLater(random.expovariate(1.0 / self.delay), self.answer, client, message)
+        else:
+            self.answer(client, message)
+
+    def answer(self, client, message):
+        if client not in self.clients:
+            return  # the connection was closed while we were "busy"
+        if message.cmd == STATUS:
+            payload = json.dumps({'devId': self.tuya_id, 'dps': self.dps, 't': int(time.time())}).encode()
+            client.transport.write(build_frame(message.seqno, STATUS, payload))
+        elif message.cmd == HEART_BEAT:
+            client.transport.write(build_frame(message.seqno, HEART_BEAT, b''))
+        elif message.cmd == SET:
+            try:
+                # version (3), signature (16), base64 of the encrypted json
+                request = json.loads(self.cipher.decrypt(b64decode(message.payload[19:]), False))
+            except Exception:
+                self.bad_key += 1
+                return  # the real devices ignore frames they can't decrypt
+            client.transport.write(build_frame(message.seqno, SET, b''))
+            self.change(request.get('dps', {}))
+
+    def random_change(self):
+        self.change({'1': not self.dps['1']})
+
+    def change(self, dps):
+        """
+        Apply new dps values and push them to every connected client.
+        """
+        self.dps.update(dps)
+        encrypted = self.cipher.encrypt(json.dumps({'devId': self.tuya_id, 'dps': dps,
+                                                    't': int(time.time())}).encode())
+        signature = md5(b'data=' + encrypted + b'||lpv=3.1||' + self.local_key.encode('latin1')).hexdigest()[8:24]
+        self.seqno += 1
+        frame = build_frame(self.seqno, PUSH, pytuya.PROTOCOL_VERSION_BYTES + signature.encode() + encrypted,
+                            retcode=False)
+        for client in self.clients:
+            client.transport.write(frame)
+
+
+class Fleet(object):
+    """
+    Many simulated devices, each on the next address of a loopback network.
+    """
+    def __init__(self, count, network, **behaviour):
+        hosts = IPNetwork(network).iter_hosts()
+        self.devices = []
+        for index in range(count):
+            tuya_id = '%020d' % index
+            local_key = '%016x' % random.getrandbits(64)
+            self.devices.append(SimulatedDevice(tuya_id, local_key, str(next(hosts)), **behaviour))
+
+    def start(self):
+        for device in self.devices:
+            device.start()
+
+    def stop(self):
+        return defer.DeferredList([device.stop() for device in self.devices])
+
+    def totals(self):
+        totals = {}
+        for name in ('connections_made', 'refused', 'requests', 'resets', 'bad_key'):
+            totals[name] = sum(getattr(device, name) for device in self.devices)
+        return totals
+
+
+class SimulatedCommand(object):
+    def __init__(self, machine_label):
+        self.machine_label = machine_label
+
+
+class SimulatedYomboDevice(object):
+    """
+    The parts of a Yombo device the module uses.
+    """
+    def __init__(self, device_id, tuya_id, local_key):
+        self.device_id = device_id
+        self.full_label = 'Simulated %s' % tuya_id
+        self.status = None
+        self.device_variables_cached = {
+            'device_id': {'values': [tuya_id]},
+            'local_key': {'values': [local_key]},
+        }
+
+    def set_status(self, **kwargs):
+        self.status = kwargs.get('machine_status')
+
+    def device_command_done(self, request_id):
+        pass
+
+
+class SimulatedConfigs(object):
+    def get(self, section, option, default=None, *args, **kwargs):
+        return default
+
+
+def build_module(fleet, network):
+    """
+    Create the module with a Yombo device for every simulated device, without a running gateway.
+    """
+    module = tuya.Tuya.__new__(tuya.Tuya)
+    module._module_starting = lambda: None
+    module._module_started = lambda: None
+    module._module_devices_cached = {}
+    for index, device in enumerate(fleet.devices):
+        device_id = 'sim%d' % index
+        module._module_devices_cached[device_id] = SimulatedYomboDevice(device_id, device.tuya_id, device.local_key)
+    module._Configs = SimulatedConfigs()
+    module._Commands = {'on': SimulatedCommand('on'), 'off': SimulatedCommand('off')}
+    module._FullName = 'modules.tuya'
+    module._Statistics = None
+    module._is_my_device = lambda device: True
+    module._init_()
+    module.get_scan_networks = lambda: [network]
+    module.build_device_index()
+    return module
+
+
+class Timings(object):
+    """
+    Latencies and errors for one phase.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.duration = None  # total seconds spent in the phase, over all rounds
+
+    def record(self, started, ok):
+        self.latencies.append(time.time() - started)
+        if not ok:
+            self.errors += 1
+
+    def percentile(self, percent):
+        if len(self.latencies) == 0:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[int(round(percent / 100.0 * (len(latencies) - 1)))]
+
+    def report(self):
+        count = len(self.latencies)
+        return {
+            'operations': count,
+            'duration': self.duration,
+            'throughput': count / self.duration if self.duration else None,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'error_rate': self.errors / count if count else None,
+        }
+
+
+def timed(function, timings, is_ok):
+    """
+    Wrap a module method so every call is recorded in timings.
+    """
+    def wrapper(*args, **kwargs):
+        started = time.time()
+        d = defer.maybeDeferred(function, *args, **kwargs)
+
+        def done(result):
+            timings.record(started, is_ok(result))
+            return result
+
+        def failed(failure):
+            timings.record(started, False)
+            return failure
+
+        return d.addCallbacks(done, failed)
+    return wrapper
+
+
+@defer.inlineCallbacks
+def run_phase(timings, action):
+    started = time.time()
+    yield action()
+    timings.duration = (timings.duration or 0) + time.time() - started
+
+
+@defer.inlineCallbacks
+def simulate(args):
+    fleet = Fleet(args.count, args.network, single_connection=not args.allow_multiple, delay=args.delay,
+                  reset_rate=args.reset_rate, push_interval=args.push_interval)
+    fleet.start()
+    module = build_module(fleet, args.network)
+    module.poller.start()
+    phases = []
+
+    scan = Timings('scan')
+    module.identify_host = timed(module.identify_host, scan, lambda result: True)  # time to identify each open host
+    yield run_phase(scan, lambda: module.scan_for_tuya_devices(fast=True))
+    phases.append(scan)
+    located = module.registry.located()
+    scan_report = scan.report()
+    scan_report['located'] = located
+    if module.scanner is not None:
+        scan_report['hosts_probed'] = module.scanner.probed
+        scan_report['probe_errors'] = module.scanner.errors
+    yield deferred_sleep(1)  # let the listeners connect
+
+    fetch = Timings('fetch_all_device_status')
+    module.poll_device = timed(module.poll_device, fetch, lambda result: result is not None)
+    module.poller.poll_function = module.poll_device
+    for round_number in range(args.rounds):
+        yield run_phase(fetch, module.fetch_all_device_status)
+    phases.append(fetch)
+
+    commands = Timings('_device_command_')
+    module.write_coalescer.send = timed(module.send_dps, commands, lambda result: True)
+    request_ids = iter(range(1000000))
+
+    def send_commands(label):
+        return defer.DeferredList([
+            module._device_command_(device=device, command=SimulatedCommand(label), request_id=next(request_ids))
+            for device in module._module_devices_cached.values()])
+
+    for round_number in range(args.rounds):
+        yield run_phase(commands, lambda: send_commands('on' if round_number % 2 == 0 else 'off'))
+    phases.append(commands)
+
+    module._unload_()
+    yield fleet.stop()
+
+    results = {timings.name: timings.report() for timings in phases}
+    results['scan'].update(scan_report)
+    results['devices'] = fleet.totals()
+    return results
+
+
+def deferred_sleep(seconds):
+    d = defer.Deferred()
+    reactor.callLater(seconds, d.callback, None)
+    return d
+
+
+def print_results(results):
+    print('%-26s %8s %10s %10s %10s %10s %8s' % ('phase', 'ops', 'seconds', 'ops/s', 'p50 ms', 'p99 ms', 'errors'))
+    for name in ('scan', 'fetch_all_device_status', '_device_command_'):
+        phase = results[name]
+
+        def ms(value):
+            return '%10.1f' % (value * 1000) if value is not None else '%10s' % '-'
+
+        print('%-26s %8d %10.2f %10.1f %s %s %7.1f%%' % (
+            name, phase['operations'], phase['duration'] or 0, phase['throughput'] or 0, ms(phase['p50']),
+            ms(phase['p99']), (phase['error_rate'] or 0) * 100))
+    print('located %(located)s devices, probed %(hosts_probed)s hosts' % dict(
+        {'hosts_probed': '-'}, **results['scan']))
+    print('device side: %s' % ', '.join('%s=%s' % item for item in sorted(results['devices'].items())))
+
+
+def raise_file_limit():
+    """
+    Each device needs a few sockets, raise the open file limit as far as allowed.
+    """
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else 65536, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=200, help='number of simulated devices')
+    parser.add_argument('--network', default='127.77.0.0/20', help='loopback network to put the devices on')
+    parser.add_argument('--rounds', type=int, default=3, help='times to repeat the status and command phases')
+    parser.add_argument('--delay', type=float, default=0.01, help='average seconds before a device answers')
+    parser.add_argument('--reset-rate', type=float, default=0, help='fraction of requests answered with a reset')
+    parser.add_argument('--push-interval', type=float, default=0,
+                        help='average seconds between random status pushes per device, 0 for none')
+    parser.add_argument('--allow-multiple', action='store_true',
+                        help='accept more than one connection per device, real devices do not')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--json', help='save the results to this file')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    raise_file_limit()
+    outcome = {}
+
+    def run():
+        d = simulate(args)
+
+        def done(results):
+            outcome['results'] = results
+
+        d.addCallbacks(done, lambda failure: failure.printTraceback())
+        d.addBoth(lambda ignored: reactor.stop())
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+    results = outcome.get('results')
+    if results is None:
+        sys.exit(1)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(dict(results, arguments=vars(args), timestamp=int(time.time())), output, indent=2,
+                      sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
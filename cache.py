@@ -0,0 +1,182 @@
+"""
+This file was created by Yombo for use with Yombo Gateway automation
+software. Details can be found at https://yombo.net
+
+Tuya Status Cache
+=================
+
+Caches the dps values reported by each device.
+
+* Concurrent lookups for the same device share a single fetch.
+* Values younger than fresh_age are returned without touching the network.
+* Values older than fresh_age, but younger than stale_age, are returned right away while a
+  background refresh updates the cache (stale-while-revalidate).
+* Anything older, or unknown, waits for the fetch.
+
+License
+=======
+
+See LICENSE.md for full license and attribution information.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+:license: Apache 2.0
+"""
+# Import python libraries
+from time import time
+
+# Import twisted libraries
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+from twisted.python.failure import Failure
+
+from yombo.core.log import get_logger
+
+logger = get_logger("modules.tuya.cache")
+
+FRESH_AGE = 5  # Seconds a status is used without asking the device.
+STALE_AGE = 300  # Seconds a status may be served while it's being refreshed.
+
+
+class CachedStatus(object):
+    """
+    The last known dps values for a single device.
+    """
+    def __init__(self):
+        self.dps = {}
+        self.updated = {}  # dps -> time the value was last reported
+        self.fetched = None  # time of the last full status fetch
+
+
+class StatusCache(object):
+    """
+    Status cache keyed by device and dps.
+
+    :param fetch: Called as fetch(*args) to get the full dps dictionary of a device, may return a deferred.
+    :param fresh_age: Seconds a status is used without asking the device.
+    :param stale_age: Seconds a status may be served while it's being refreshed.
+    """
+    def __init__(self, fetch, fresh_age=None, stale_age=None):
+        if fresh_age is None:
+            fresh_age = FRESH_AGE
+        if stale_age is None:
+            stale_age = STALE_AGE
+        self.fetch_function = fetch
+        self.fresh_age = fresh_age
+        self.stale_age = stale_age
+        self.devices = {}
+        self.in_flight = {}  # key -> list of deferreds waiting on the fetch
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.devices
+
+    def get(self, key, dps=None, max_age=None):
+        """
+        Get cached values without going to the network.
+
+        :param key: The device key, usually the Tuya device id.
+        :param dps: A single dps index (string), or None for the whole dictionary.
+        :param max_age: Only return values reported within this many seconds.
+        :return: The value, a copy of the dps dictionary, or None if not known.
+        """
+        cached = self.devices.get(key)
+        if cached is None:
+            return None
+        if dps is None:
+            if max_age is not None and (cached.fetched is None or time() - cached.fetched > max_age):
+                return None
+            return dict(cached.dps)
+        if dps not in cached.dps:
+            return None
+        if max_age is not None and time() - cached.updated[dps] > max_age:
+            return None
+        return cached.dps[dps]
+
+    def age(self, key):
+        """
+        Seconds since the last full status fetch for a device, None if never fetched.
+        """
+        cached = self.devices.get(key)
+        if cached is None or cached.fetched is None:
+            return None
+        return time() - cached.fetched
+
+    def update(self, key, dps, full=False):
+        """
+        Store dps values reported by a device, from a status reply, a command acknowledgement or
+        a status update pushed by the device.
+
+        :param key: The device key.
+        :param dps: Dictionary of dps index (string) -> value.
+        :param full: True if dps is the device's complete status.
+        :return:
+        """
+        cached = self.devices.get(key)
+        if cached is None:
+            cached = self.devices[key] = CachedStatus()
+        now = time()
+        if full:
+            cached.dps = dict(dps)
+            cached.updated = dict.fromkeys(dps, now)
+            cached.fetched = now
+        else:
+            cached.dps.update(dps)
+            for index in dps:
+                cached.updated[index] = now
+
+    def invalidate(self, key):
+        self.devices.pop(key, None)
+
+    def lookup(self, key, *args, allow_cache=True):
+        """
+        Get the full dps dictionary for a device, using the cache when allowed.
+
+        :param key: The device key.
+        :param args: Passed to the fetch function.
+        :param allow_cache: If False, always wait for a fresh fetch.
+        :return: Deferred that fires with the dps dictionary.
+        """
+        age = self.age(key)
+        if allow_cache is not False and age is not None:
+            if age <= self.fresh_age:
+                self.hits += 1
+                return succeed(dict(self.devices[key].dps))
+            if age <= self.stale_age:
+                self.stale_hits += 1
+                refresh = self.fetch(key, *args)
+                refresh.addErrback(self._refresh_failed, key)
+                return succeed(dict(self.devices[key].dps))
+        self.misses += 1
+        return self.fetch(key, *args)
+
+    def fetch(self, key, *args):
+        """
+        Fetch the status from the device, sharing the fetch if one is already running.
+
+        :param key: The device key.
+        :param args: Passed to the fetch function.
+        :return: Deferred that fires with the dps dictionary.
+        """
+        d = Deferred()
+        waiting = self.in_flight.get(key)
+        if waiting is not None:
+            waiting.append(d)
+            return d
+        self.in_flight[key] = [d]
+        maybeDeferred(self.fetch_function, *args).addBoth(self._fetched, key)
+        return d
+
+    def _fetched(self, result, key):
+        waiting = self.in_flight.pop(key, [])
+        if not isinstance(result, Failure):
+            self.update(key, result, full=True)
+        for d in waiting:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(dict(result))
+
+    def _refresh_failed(self, failure, key):
+        logger.debug("Background status refresh failed for {key}: {error}", key=key, error=failure.getErrorMessage())
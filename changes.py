@@ -0,0 +1,152 @@
+"""
+This file was created by Yombo for use with Yombo Gateway automation
+software. Details can be found at https://yombo.net
+
+Tuya Changes
+============
+
+Works out which dps values actually changed, and publishes device status in batches.
+
+Replies and pushes are compared against the last values published for the device, and only the dps
+that differ are reported. Numbers that wander a little between readings, such as power and voltage,
+are debounced: a small change is only published once the last published value is old enough, so a
+plug's power reading doesn't generate a status update on every poll.
+
+Changes are collected for a short time and published together. A device that changes several
+times within the window gets one status update with its latest values.
+
+License
+=======
+
+See LICENSE.md for full license and attribution information.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+:license: Apache 2.0
+"""
+# Import python libraries
+from time import time
+
+# Import twisted libraries
+from twisted.internet import reactor
+
+from yombo.core.log import get_logger
+
+logger = get_logger("modules.tuya.changes")
+
+NOISE_THRESHOLD = 0.05  # Numbers that changed by less than this fraction are noise...
+NOISE_DEBOUNCE = 60  # ...and are only published if the last published value is this many seconds old.
+PUBLISH_INTERVAL = 1  # Seconds to collect changes for before publishing them.
+
+
+class ChangeDetector(object):
+    """
+    Tracks the last published dps values of every device.
+
+    :param threshold: Fraction a number has to change by to be published right away.
+    :param debounce: Seconds after which small changes to a number are published anyway.
+    """
+    def __init__(self, threshold=None, debounce=None):
+        self.threshold = NOISE_THRESHOLD if threshold is None else threshold
+        self.debounce = NOISE_DEBOUNCE if debounce is None else debounce
+        self.known = {}  # key -> dps index -> last published value
+        self.published = {}  # key -> dps index -> time the value was published
+
+    def diff(self, key, dps):
+        """
+        Compare new dps values against the last published ones and record the ones that changed.
+
+        :param key: The device key.
+        :param dps: Dictionary of dps index (string) -> value, all of the device's dps or only some.
+        :return: Dictionary of the dps that changed, empty if nothing did.
+        """
+        known = self.known.setdefault(key, {})
+        published = self.published.setdefault(key, {})
+        now = time()
+        changes = {}
+        for index, value in dps.items():
+            if index in known:
+                old = known[index]
+                if old == value:
+                    continue
+                if self.is_noise(old, value) and now - published[index] < self.debounce:
+                    continue
+            changes[index] = value
+            known[index] = value
+            published[index] = now
+        return changes
+
+    def is_noise(self, old, new):
+        """
+        Check if a change is small enough to be debounced. Only numbers are ever noise.
+        """
+        if isinstance(old, bool) or isinstance(new, bool):
+            return False
+        if not isinstance(old, (int, float)) or not isinstance(new, (int, float)):
+            return False
+        return abs(new - old) < self.threshold * max(abs(old), 1)
+
+    def get(self, key):
+        """
+        The last published dps values of a device, None if nothing has been published.
+        """
+        known = self.known.get(key)
+        if known is None:
+            return None
+        return dict(known)
+
+    def forget(self, key):
+        self.known.pop(key, None)
+        self.published.pop(key, None)
+
+
+class StatusPublisher(object):
+    """
+    Collects status changes and publishes them together.
+
+    :param publish: Called as publish(device, changes, status) for each device with changes.
+    :param interval: Seconds to collect changes for.
+    """
+    def __init__(self, publish, interval=None):
+        self.publish = publish
+        self.interval = PUBLISH_INTERVAL if interval is None else interval
+        self.pending = {}  # Yombo device_id -> [device, changes, status]
+        self.call = None
+        self.batches = 0
+
+    def add(self, device, changes, status):
+        """
+        Queue changes for a device, merged with any already waiting.
+
+        :param device: The Yombo device.
+        :param changes: Dictionary of the dps that changed.
+        :param status: The device's complete dps values.
+        :return:
+        """
+        entry = self.pending.get(device.device_id)
+        if entry is None:
+            self.pending[device.device_id] = [device, dict(changes), status]
+        else:
+            entry[1].update(changes)
+            entry[2] = status
+        if self.call is None:
+            self.call = reactor.callLater(self.interval, self.flush)
+
+    def flush(self):
+        """
+        Publish everything waiting now.
+
+        :return:
+        """
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+        pending, self.pending = self.pending, {}
+        if len(pending) == 0:
+            return
+        self.batches += 1
+        logger.debug("Publishing status of {count} devices.", count=len(pending))
+        for device, changes, status in pending.values():
+            try:
+                self.publish(device, changes, status)
+            except Exception as e:
+                logger.warn("Unable to publish status of {label}: {e}", label=device.full_label, e=e)
@@ -0,0 +1,235 @@
+"""
+This file was created by Yombo for use with Yombo Gateway automation
+software. Details can be found at https://yombo.net
+
+Tuya Commands
+=============
+
+Helpers to reduce the number of connections made to the devices. The devices only accept one
+connection at a time, so every extra round trip delays everything else queued for the device.
+
+License
+=======
+
+See LICENSE.md for full license and attribution information.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+:license: Apache 2.0
+"""
+# Import python libraries
+from heapq import heappop, heappush
+from itertools import count
+from time import time
+
+# Import twisted libraries
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python.failure import Failure
+
+from yombo.core.exceptions import YomboWarning
+from yombo.core.log import get_logger
+
+logger = get_logger("modules.tuya.commands")
+
+WRITE_COALESCE_WINDOW = 0.02  # Seconds to wait for more writes to the same device before sending.
+COMMAND_DEADLINE = 5  # Seconds a request may wait in a device's queue before it's dropped.
+PRIORITY_USER = 0  # Commands from users, scenes and automation rules.
+PRIORITY_POLL = 10  # Background status polling.
+
+
+class PendingWrite(object):
+    """
+    DPS values collected for a device, waiting to be sent as one SET frame.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.dps = {}
+        self.deferreds = []
+        self.call = None
+
+
+class WriteCoalescer(object):
+    """
+    Merges DPS writes to the same device that arrive within a short window into a single SET frame.
+    Every caller's deferred fires with the device's one reply. If the same DPS is written more than
+    once during the window, the last value wins.
+
+    :param send: Called as send(device, dps) to send the merged write, may return a deferred.
+    :param window: Seconds to collect writes for.
+    """
+    def __init__(self, send, window=None):
+        if window is None:
+            window = WRITE_COALESCE_WINDOW
+        self.send = send
+        self.window = window
+        self.pending = {}
+
+    def write(self, device, dps):
+        """
+        Queue DPS values to be written.
+
+        :param device: The registry.DeviceRecord of the device.
+        :param dps: Dictionary of dps index (string) -> value.
+        :return: Deferred that fires with the device's reply.
+        """
+        key = device.tuya_id
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = PendingWrite(device)
+            entry.call = reactor.callLater(self.window, self.flush, key)
+            self.pending[key] = entry
+        entry.dps.update(dps)
+        d = Deferred()
+        entry.deferreds.append(d)
+        return d
+
+    def flush(self, key):
+        """
+        Send the collected writes for a device now.
+
+        :param key: The Tuya device id.
+        :return:
+        """
+        entry = self.pending.pop(key, None)
+        if entry is None:
+            return
+        if entry.call.active():
+            entry.call.cancel()
+        if len(entry.deferreds) > 1:
+            logger.debug("Merged {count} writes to {label}: {dps}",
+                         count=len(entry.deferreds), label=entry.device.full_label, dps=entry.dps)
+
+        def fire(result):
+            for d in entry.deferreds:
+                if isinstance(result, Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+
+        maybeDeferred(self.send, entry.device, entry.dps).addBoth(fire)
+
+    def flush_all(self):
+        for key in list(self.pending.keys()):
+            self.flush(key)
+
+
+class CommandExpired(YomboWarning):
+    """
+    Raised when a queued command passed its deadline before it could be sent.
+    """
+    pass
+
+
+class QueuedCommand(object):
+    """
+    A request waiting in a DeviceQueue.
+    """
+    def __init__(self, function, args, kwargs, priority, deadline, collapse_key):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.deadline = deadline
+        self.collapse_key = collapse_key
+        self.deferreds = []
+        self.superseded = False
+
+
+class DeviceQueue(object):
+    """
+    The pending requests for one device, run one at a time.
+    """
+    def __init__(self):
+        self.entries = []  # heap of (priority, sequence, QueuedCommand)
+        self.collapsible = {}  # collapse_key -> QueuedCommand that hasn't started yet
+        self.running = None
+
+
+class CommandQueue(object):
+    """
+    Serializes all network requests to each device, since the devices only accept one connection
+    at a time. Requests with a lower priority number go first, so user commands don't wait behind
+    background polls.
+
+    A request with a collapse_key replaces any request with the same key that hasn't started yet,
+    for example on -> off -> on only sends the final on. The replaced request's callers get the
+    result of the one that replaced it.
+
+    Requests that are still waiting when their deadline passes are dropped instead of sent, their
+    deferreds errback with CommandExpired.
+    """
+    def __init__(self):
+        self.queues = {}
+        self.sequence = count()
+
+    def submit(self, key, function, *args, priority=PRIORITY_USER, timeout=None, collapse_key=None, **kwargs):
+        """
+        Queue a request.
+
+        :param key: What to serialize on, usually the Tuya device id.
+        :param function: Called with args and kwargs when it's this request's turn, may return a deferred.
+        :param priority: PRIORITY_USER or PRIORITY_POLL, lower goes first.
+        :param timeout: Seconds the request may wait in the queue, defaults to COMMAND_DEADLINE.
+        :param collapse_key: Requests with the same key replace each other while waiting.
+        :return: Deferred that fires with the result of the function.
+        """
+        if timeout is None:
+            timeout = COMMAND_DEADLINE
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = DeviceQueue()
+
+        entry = QueuedCommand(function, args, kwargs, priority, time() + timeout, collapse_key)
+        d = Deferred()
+        entry.deferreds.append(d)
+        if collapse_key is not None:
+            previous = queue.collapsible.get(collapse_key)
+            if previous is not None:
+                previous.superseded = True
+                entry.deferreds[:0] = previous.deferreds  # older callers are answered first
+                entry.priority = min(entry.priority, previous.priority)
+            queue.collapsible[collapse_key] = entry
+        heappush(queue.entries, (entry.priority, next(self.sequence), entry))
+        if queue.running is None:
+            self._run_next(key, queue)
+        return d
+
+    def _run_next(self, key, queue):
+        if queue.running is not None:
+            return
+        while len(queue.entries) > 0:
+            priority, sequence, entry = heappop(queue.entries)
+            if entry.superseded:
+                continue
+            if entry.collapse_key is not None:
+                queue.collapsible.pop(entry.collapse_key, None)
+            if time() > entry.deadline:
+                logger.debug("Dropping expired command for {key}", key=key)
+                failure = Failure(CommandExpired("Command expired before it could be sent."))
+                for d in entry.deferreds:
+                    d.errback(failure)
+                continue
+            queue.running = entry
+            maybeDeferred(entry.function, *entry.args, **entry.kwargs).addBoth(self._finished, key, queue, entry)
+            return
+        if self.queues.get(key) is queue:
+            del self.queues[key]
+
+    def _finished(self, result, key, queue, entry):
+        queue.running = None
+        for d in entry.deferreds:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        reactor.callLater(0, self._run_next, key, queue)
+
+    def pending(self, key):
+        """
+        Number of requests waiting or running for a device.
+        """
+        queue = self.queues.get(key)
+        if queue is None:
+            return 0
+        return len([item for item in queue.entries if item[2].superseded is False]) + \
+            (1 if queue.running is not None else 0)
@@ -0,0 +1,141 @@
+"""
+This file was created by Yombo for use with Yombo Gateway automation
+software. Details can be found at https://yombo.net
+
+Tuya Discovery
+==============
+
+Passive discovery of Tuya devices. Once configured, the devices broadcast their gwId (device id),
+IP address and protocol version every few seconds. Version 3.1 devices broadcast in plain text on
+UDP port 6666, newer devices broadcast on UDP port 6667 encrypted with a well known key.
+
+Listening for these broadcasts lets the module find devices without sweeping the entire subnet.
+
+License
+=======
+
+See LICENSE.md for full license and attribution information.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+:license: Apache 2.0
+"""
+# Import python libraries
+try:  # Prefer simplejson if installed, otherwise json will work swell.
+    import simplejson as json
+except ImportError:
+    import json
+from hashlib import md5
+from time import time
+
+# Import twisted libraries
+from twisted.internet import reactor
+from twisted.internet.error import CannotListenError
+from twisted.internet.protocol import DatagramProtocol
+
+from yombo.core.log import get_logger
+
+from . import pytuya
+
+logger = get_logger("modules.tuya.discovery")
+
+DISCOVERY_PORTS = (6666, 6667)
+UDP_KEY = md5(b'yGAdlopoPVldABfn').digest()  # Used by devices to encrypt broadcasts on port 6667.
+MAX_AGE = 60  # Seconds before a device that stopped broadcasting is considered gone.
+
+
+class TuyaDiscoveryProtocol(DatagramProtocol):
+    """
+    Decodes the broadcasts on one of the discovery ports and passes them to TuyaDiscovery.
+    """
+    def __init__(self, discovery, encrypted):
+        self.discovery = discovery
+        self.encrypted = encrypted
+        self.cipher = pytuya.AESCipher(UDP_KEY)
+
+    def datagramReceived(self, datagram, address):
+        for message in pytuya.FrameDecoder().feed(datagram):
+            payload = message.payload
+            try:
+                if self.encrypted:
+                    payload = self.cipher.decrypt(payload, use_base64=False)
+                if not isinstance(payload, str):
+                    payload = payload.decode()
+                data = json.loads(payload)
+            except Exception as e:
+                logger.debug("Unable to decode Tuya broadcast from {address}: {e}", address=address[0], e=e)
+                continue
+            if 'gwId' not in data:
+                continue
+            self.discovery.device_heard(data['gwId'], data.get('ip', address[0]), data.get('version'))
+
+
+class TuyaDiscovery(object):
+    """
+    Keeps a live map of Tuya device id -> IP address from the devices' broadcasts.
+
+    :param callback: Called with (tuya_id, address, version) when a device is first heard, or its address
+        changed.
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.devices = {}
+        self.listeners = []
+
+    def start(self):
+        for port in DISCOVERY_PORTS:
+            try:
+                # listenMulticast sets SO_REUSEADDR, so other Tuya tools on this host can still listen.
+                listener = reactor.listenMulticast(port, TuyaDiscoveryProtocol(self, port != 6666),
+                                                   listenMultiple=True)
+            except CannotListenError as e:
+                logger.warn("Unable to listen for Tuya broadcasts on port {port}: {e}", port=port, e=e)
+                continue
+            self.listeners.append(listener)
+
+    def stop(self):
+        for listener in self.listeners:
+            listener.stopListening()
+        self.listeners = []
+
+    def device_heard(self, tuya_id, address, version):
+        """
+        Called for every broadcast received.
+
+        :param tuya_id: The device id (gwId) of the device.
+        :param address: IP address of the device.
+        :param version: Protocol version the device speaks.
+        """
+        existing = self.devices.get(tuya_id)
+        self.devices[tuya_id] = {
+            'address': address,
+            'version': version,
+            'last_seen': time(),
+        }
+        if existing is None or existing['address'] != address:
+            logger.debug("Heard Tuya device {tuya_id} at {address}", tuya_id=tuya_id, address=address)
+            if self.callback is not None:
+                self.callback(tuya_id, address, version)
+
+    def get(self, tuya_id, max_age=None):
+        """
+        Get the last broadcast details for a device, if it's been heard from recently.
+
+        :param tuya_id: The device id (gwId) of the device.
+        :param max_age: Seconds since the last broadcast, defaults to MAX_AGE.
+        :return: Dictionary with address, version and last_seen, or None.
+        """
+        if max_age is None:
+            max_age = MAX_AGE
+        details = self.devices.get(tuya_id)
+        if details is None or time() - details['last_seen'] > max_age:
+            return None
+        return details
+
+    def addresses(self, max_age=None):
+        """
+        All the IP addresses heard from recently.
+        """
+        if max_age is None:
+            max_age = MAX_AGE
+        now = time()
+        return set(details['address'] for details in self.devices.values() if now - details['last_seen'] <= max_age)
@@ -0,0 +1,233 @@
+"""
+This file was created by Yombo for use with Yombo Gateway automation
+software. Details can be found at https://yombo.net
+
+Tuya Effects
+============
+
+Plays colour effects, such as fades, on bulbs.
+
+* Colour ramps are computed once, as a batch, before the effect starts.
+* Each bulb is streamed to over its listener's connection, no connection is opened per colour.
+* Frames are picked by time, not counted, so every bulb in an effect shows the same frame and a
+  slow tick never makes the effect run long.
+* A bulb only has one frame in flight. When it hasn't acknowledged the previous frame yet, the new
+  frame is dropped instead of queued, so a slow bulb skips ahead instead of falling behind. The
+  final frame of an effect is always delivered.
+
+License
+=======
+
+See LICENSE.md for full license and attribution information.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+:license: Apache 2.0
+"""
+# Import python libraries
+from time import time
+
+# Import twisted libraries
+from twisted.internet.defer import Deferred, DeferredList, succeed
+from twisted.internet.task import LoopingCall
+from twisted.python.failure import Failure
+
+from yombo.core.log import get_logger
+
+from . import pytuya
+
+logger = get_logger("modules.tuya.effects")
+
+DEFAULT_FPS = 10  # Frames per second, most bulbs can't keep up with much more.
+TICK_INTERVAL = 0.02  # Seconds between scheduler ticks while an effect is playing.
+FRAME_TIMEOUT = 2  # Seconds to wait for a bulb to acknowledge a frame.
+
+
+def colour_ramp(colours, steps):
+    """
+    Interpolate between colours, evenly spread over the given number of steps.
+
+    :param colours: Two or more (r, g, b) tuples to fade through, in order.
+    :param steps: Total number of colours to return, including the first and last.
+    :return: List of (r, g, b) tuples.
+    """
+    if len(colours) == 1 or steps <= 1:
+        return [tuple(colours[-1])] * max(1, steps)
+    segments = len(colours) - 1
+    ramp = []
+    for step in range(steps):
+        position = step * segments / (steps - 1)  # how far along the colours list, as a float
+        index = min(int(position), segments - 1)
+        fraction = position - index
+        start, end = colours[index], colours[index + 1]
+        ramp.append(tuple(int(round(start[i] + (end[i] - start[i]) * fraction)) for i in range(3)))
+    return ramp
+
+
+def colour_frames(colours):
+    """
+    Convert a sequence of colours into the dps values to send, all at once.
+
+    :param colours: List of (r, g, b) tuples.
+    :return: List of dps dictionaries.
+    """
+    return [{'2': 'colour', '5': value} for value in pytuya.BulbDevice.colour_hexes(colours)]
+
+
+class BulbStream(object):
+    """
+    Sends frames to one bulb, keeping at most one frame in flight.
+
+    :param tuya_device: The bulb's pytuya device, used to encode the frames.
+    :param listener: The bulb's protocol.TuyaListenerFactory, frames are sent over its connection.
+    :param timeout: Seconds to wait for a frame to be acknowledged.
+    """
+    def __init__(self, tuya_device, listener, timeout=None):
+        self.tuya = tuya_device
+        self.listener = listener
+        self.timeout = FRAME_TIMEOUT if timeout is None else timeout
+        self.in_flight = False
+        self.final = None  # final frame waiting for the one in flight to be acknowledged
+        self.waiting = []  # deferreds from drained()
+
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def offer(self, dps, final=False):
+        """
+        Send a frame if the bulb can take it now, otherwise drop it. A final frame is never
+        dropped, it's sent once the bulb acknowledges the frame in flight.
+
+        :param dps: The frame's dps values.
+        :param final: True for the last frame of an effect.
+        :return: True if the frame was sent.
+        """
+        if self.in_flight:
+            if final:
+                self.final = dps
+            else:
+                self.dropped += 1
+            return False
+        if self.listener.connected is False:
+            self.dropped += 1
+            return False
+        self.final = None
+        self.in_flight = True
+        self.sent += 1
+        payload = self.tuya.generate_payload(pytuya.SET, dps)
+        self.listener.request(payload, self.timeout).addBoth(self._acknowledged)
+        return True
+
+    def _acknowledged(self, result):
+        self.in_flight = False
+        if isinstance(result, Failure):
+            self.errors += 1
+            logger.debug("Bulb {bulb} didn't take a frame: {error}", bulb=self.tuya.id, error=result.getErrorMessage())
+        if self.final is not None:
+            self.offer(self.final, final=True)
+        elif len(self.waiting) > 0:
+            waiting, self.waiting = self.waiting, []
+            for d in waiting:
+                d.callback(None)
+
+    def drained(self):
+        """
+        :return: Deferred that fires once the bulb has acknowledged every frame sent to it.
+        """
+        if self.in_flight is False and self.final is None:
+            return succeed(None)
+        d = Deferred()
+        self.waiting.append(d)
+        return d
+
+    def stats(self):
+        return {'sent': self.sent, 'dropped': self.dropped, 'errors': self.errors}
+
+
+class Effect(object):
+    """
+    A sequence of frames played on a group of bulbs.
+    """
+    def __init__(self, streams, frames, fps, loop):
+        self.streams = streams
+        self.frames = frames
+        self.fps = fps
+        self.loop = loop
+        self.started = None
+        self.last_index = None
+        self.deferred = Deferred()
+
+
+class EffectScheduler(object):
+    """
+    Plays effects on many bulbs from a single timer.
+
+    :param tick_interval: Seconds between ticks while any effect is playing.
+    """
+    def __init__(self, tick_interval=None):
+        self.tick_interval = TICK_INTERVAL if tick_interval is None else tick_interval
+        self.effects = []
+        self.ticker = LoopingCall(self._tick)
+
+    def play(self, streams, frames, fps=None, loop=False):
+        """
+        Start an effect. All the bulbs show the same frame at the same time.
+
+        :param streams: BulbStream for each bulb.
+        :param frames: List of dps dictionaries, see colour_frames().
+        :param fps: Frames per second, defaults to DEFAULT_FPS.
+        :param loop: Repeat until stopped.
+        :return: Deferred that fires with BulbStream.stats() for each bulb when the effect ends.
+        """
+        effect = Effect(streams, frames, DEFAULT_FPS if fps is None else fps, loop)
+        effect.started = time()
+        self.effects.append(effect)
+        if self.ticker.running is False:
+            self.ticker.start(self.tick_interval)
+        return effect.deferred
+
+    def stop(self, deferred=None):
+        """
+        Stop an effect, the one whose deferred was returned by play(), or all of them. The bulbs
+        are left showing whichever frame they last took.
+
+        :param deferred:
+        :return:
+        """
+        for effect in list(self.effects):
+            if deferred is None or effect.deferred is deferred:
+                for stream in effect.streams:
+                    stream.final = None
+                self._finish(effect)
+
+    def _tick(self):
+        if len(self.effects) == 0:
+            self.ticker.stop()  # stopped here rather than in _finish(), so play() is safe from its callbacks
+            return
+        now = time()
+        for effect in list(self.effects):
+            index = int((now - effect.started) * effect.fps)
+            if index >= len(effect.frames) and effect.loop is False:
+                if effect.last_index != len(effect.frames) - 1:
+                    for stream in effect.streams:
+                        stream.offer(effect.frames[-1], final=True)
+                self._finish(effect)
+                continue
+            index %= len(effect.frames)
+            if index == effect.last_index:
+                continue  # not time for the next frame yet
+            effect.last_index = index
+            final = index == len(effect.frames) - 1 and effect.loop is False
+            for stream in effect.streams:
+                stream.offer(effect.frames[index], final)
+
+    def _finish(self, effect):
+        """
+        Fire the effect's deferred once every bulb has acknowledged its last frame.
+        """
+        self.effects.remove(effect)
+
+        def drained(ignored):
+            effect.deferred.callback({stream.tuya.id: stream.stats() for stream in effect.streams})
+
+        DeferredList([stream.drained() for stream in effect.streams]).addCallback(drained)
@@ -0,0 +1,316 @@
+"""
+This file was created by Yombo for use with Yombo Gateway automation
+software. Details can be found at https://yombo.net
+
+Tuya Metrics
+============
+
+Counters, gauges and per-device latency histograms for the module.
+
+Totals are also sent to Yombo's statistics library as they happen. The full set, including the
+per-device values, is available as a Prometheus text snapshot from TuyaMetrics.prometheus().
+
+License
+=======
+
+See LICENSE.md for full license and attribution information.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+:license: Apache 2.0
+"""
+# Import python libraries
+from bisect import bisect_left
+from time import time
+
+# Import twisted libraries
+from twisted.internet.defer import maybeDeferred
+from twisted.internet.error import ConnectionDone, ConnectionLost, TimeoutError
+
+from yombo.core.log import get_logger
+
+logger = get_logger("modules.tuya.metrics")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)  # Seconds.
+STATISTICS_PREFIX = "modules.tuya."
+STATISTICS_BUCKET_SIZE = 60
+
+DESCRIPTIONS = {
+    'tuya_request_seconds': ('histogram', 'Round trip time of requests to a device.'),
+    'tuya_request_errors_total': ('counter', 'Requests to a device that failed, by reason.'),
+    'tuya_pushes_total': ('counter', 'Status updates pushed by a device.'),
+    'tuya_retries_total': ('counter', 'Requests that were retried.'),
+    'tuya_scans_total': ('counter', 'Network scans, by whether the subnet had to be swept.'),
+    'tuya_scan_duration_seconds': ('gauge', 'Duration of the last network sweep.'),
+    'tuya_scan_hosts_probed': ('gauge', 'Hosts probed by the last network sweep.'),
+    'tuya_scan_open_hosts': ('gauge', 'Hosts with the Tuya port open in the last network sweep.'),
+    'tuya_scan_errors': ('gauge', 'Local errors during the last network sweep.'),
+}
+
+
+class Histogram(object):
+    """
+    Counts of observed values by bucket upper bound.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+
+    def cumulative(self):
+        """
+        :return: List of (upper bound, observations at or below it), ending with +Inf.
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((bound, total))
+        result.append((float('inf'), self.count))
+        return result
+
+    def quantile(self, fraction):
+        """
+        Approximate quantile: the upper bound of the bucket it falls in, None if nothing was observed.
+        """
+        if self.count == 0:
+            return None
+        for bound, total in self.cumulative():
+            if total >= fraction * self.count:
+                return bound
+
+    @property
+    def average(self):
+        return self.sum / self.count if self.count else None
+
+
+class TuyaMetrics(object):
+    """
+    Collects the module's metrics.
+
+    :param statistics: The Yombo statistics library, or None to only keep them locally.
+    :param buckets: Latency histogram bucket bounds, in seconds.
+    """
+    def __init__(self, statistics=None, buckets=None):
+        self.statistics = statistics
+        self.buckets = LATENCY_BUCKETS if buckets is None else buckets
+        self.latency = {}  # (tuya_id, operation) -> Histogram
+        self.counters = {}  # metric name -> {labels tuple -> value}
+        self.gauges = {}  # metric name -> (help, function returning the value)
+        self.last_scan = {}
+
+    def add_gauge(self, name, description, function):
+        """
+        Register a value that's read when a snapshot is taken, such as a queue depth.
+
+        :param name: Prometheus metric name.
+        :param description: Help text.
+        :param function: Called without arguments, returns a number.
+        :return:
+        """
+        self.gauges[name] = (description, function)
+
+    def increment(self, name, amount=1, **labels):
+        """
+        Increment a counter.
+
+        :param name: Prometheus metric name, ending with _total.
+        :param amount:
+        :param labels: Label name -> value.
+        :return:
+        """
+        values = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        values[key] = values.get(key, 0) + amount
+        self._statistic('increment', name, labels, amount)
+
+    def observe(self, operation, key, seconds):
+        """
+        Record a successful request's round trip time.
+
+        :param operation: 'status' or 'set'.
+        :param key: The Tuya device id.
+        :param seconds:
+        :return:
+        """
+        histogram = self.latency.get((key, operation))
+        if histogram is None:
+            histogram = self.latency[(key, operation)] = Histogram(self.buckets)
+        histogram.observe(seconds)
+        if self.statistics is not None:
+            self.statistics.averages(STATISTICS_PREFIX + "latency." + operation, seconds,
+                                     bucket_size=STATISTICS_BUCKET_SIZE, anon=True)
+
+    def timed(self, operation, key, function):
+        """
+        Wrap a request function so its round trip time or failure is recorded.
+
+        :param operation: 'status' or 'set'.
+        :param key: The Tuya device id.
+        :param function: The request, may return a deferred.
+        :return: The wrapped function.
+        """
+        def request(*args, **kwargs):
+            started = time()
+            d = maybeDeferred(function, *args, **kwargs)
+
+            def succeeded(result):
+                self.observe(operation, key, time() - started)
+                return result
+
+            def failed(failure):
+                if failure.check(TimeoutError):
+                    reason = 'timeout'
+                elif failure.check(ConnectionDone, ConnectionLost):
+                    reason = 'reset'
+                else:
+                    reason = 'other'
+                self.increment('tuya_request_errors_total', device=key, operation=operation, reason=reason)
+                return failure
+
+            return d.addCallbacks(succeeded, failed)
+        return request
+
+    def scan_finished(self, scanner=None, swept=False):
+        """
+        Record a scan.
+
+        :param scanner: The last NetworkScanner the scan ran, None if no hosts were probed.
+        :param swept: True if the network was swept, not only the neighbor table probed.
+        :return:
+        """
+        self.increment('tuya_scans_total', swept='true' if swept else 'false')
+        if scanner is None:
+            return
+        self.last_scan = {
+            'tuya_scan_duration_seconds': scanner.duration,
+            'tuya_scan_hosts_probed': scanner.probed,
+            'tuya_scan_open_hosts': scanner.open_hosts,
+            'tuya_scan_errors': scanner.errors,
+        }
+        if self.statistics is not None:
+            for name, value in self.last_scan.items():
+                self.statistics.datapoint(STATISTICS_PREFIX + name[len('tuya_'):].replace('_', '.', 1), value,
+                                          anon=True)
+
+    def publish(self):
+        """
+        Send the current value of every gauge to Yombo's statistics.
+
+        :return:
+        """
+        if self.statistics is None:
+            return
+        for name, (description, function) in self.gauges.items():
+            try:
+                value = function()
+            except Exception as e:
+                logger.debug("Unable to read metric {name}: {e}", name=name, e=e)
+                continue
+            if value is not None:
+                self.statistics.datapoint(STATISTICS_PREFIX + name[len('tuya_'):], value, anon=True)
+
+    def average(self, key, operation):
+        """
+        Average round trip time of a device, None if it hasn't answered yet.
+        """
+        histogram = self.latency.get((key, operation))
+        if histogram is None:
+            return None
+        return histogram.average
+
+    def slowest_devices(self, count=10, operation='status'):
+        """
+        The devices with the highest average round trip time.
+
+        :return: List of (tuya_id, average seconds, requests), slowest first.
+        """
+        devices = [(key, histogram.average, histogram.count) for (key, histogram_operation), histogram
+                   in self.latency.items() if histogram_operation == operation and histogram.count > 0]
+        devices.sort(key=lambda item: item[1], reverse=True)
+        return devices[:count]
+
+    def _statistic(self, method, name, labels, amount):
+        """
+        Send a counter to Yombo's statistics. Only totals by operation and reason are sent, not per
+        device, to keep the number of buckets small.
+        """
+        if self.statistics is None:
+            return
+        bucket = STATISTICS_PREFIX + name[len('tuya_'):-len('_total')]
+        for label in ('operation', 'reason', 'swept'):
+            if label in labels:
+                bucket += "." + labels[label]
+        for i in range(amount):
+            getattr(self.statistics, method)(bucket, bucket_size=STATISTICS_BUCKET_SIZE, anon=True)
+
+    def prometheus(self):
+        """
+        Take a snapshot of every metric, in the Prometheus text exposition format.
+
+        :return: String.
+        """
+        lines = []
+
+        def header(name, kind=None, description=None):
+            if kind is None:
+                kind, description = DESCRIPTIONS[name]
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, kind))
+
+        name = 'tuya_request_seconds'
+        header(name)
+        for (key, operation), histogram in sorted(self.latency.items()):
+            labels = 'device="%s",operation="%s"' % (_escape(key), operation)
+            for bound, total in histogram.cumulative():
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, _format_bound(bound), total))
+            lines.append('%s_sum{%s} %r' % (name, labels, histogram.sum))
+            lines.append('%s_count{%s} %d' % (name, labels, histogram.count))
+
+        for name, values in sorted(self.counters.items()):
+            if name in DESCRIPTIONS:
+                header(name)
+            else:
+                header(name, 'counter', name)
+            for key, value in sorted(values.items()):
+                lines.append('%s%s %s' % (name, _format_labels(key), value))
+
+        for name, value in sorted(self.last_scan.items()):
+            header(name)
+            lines.append('%s %s' % (name, value))
+
+        for name, (description, function) in sorted(self.gauges.items()):
+            try:
+                value = function()
+            except Exception as e:
+                logger.debug("Unable to read metric {name}: {e}", name=name, e=e)
+                continue
+            if value is None:
+                continue
+            header(name, 'gauge', description)
+            lines.append('%s %s' % (name, value))
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key):
+    if len(key) == 0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in key)
+
+
+def _format_bound(bound):
+    if bound == float('inf'):
+        return '+Inf'
+    return repr(float(bound))
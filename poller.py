@@ -0,0 +1,220 @@
+"""
+This file was created by Yombo for use with Yombo Gateway automation
+software. Details can be found at https://yombo.net
+
+Tuya Poller
+===========
+
+Schedules status polls so the load stays flat no matter how many devices there are.
+
+* Every device has its own poll interval. It tightens when the device's status changes or a
+  command is sent to it, and grows while the device is idle. Devices that don't answer back off
+  even further.
+* Each poll is scheduled with some jitter, so devices don't line up and get polled in bursts.
+* Only max_in_flight polls run at once, due polls wait for a free slot.
+
+License
+=======
+
+See LICENSE.md for full license and attribution information.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+:license: Apache 2.0
+"""
+# Import python libraries
+from heapq import heappop, heappush
+from itertools import count
+from random import random, uniform
+from time import time
+
+# Import twisted libraries
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredList, maybeDeferred
+from twisted.python.failure import Failure
+
+from yombo.core.log import get_logger
+
+logger = get_logger("modules.tuya.poller")
+
+MIN_INTERVAL = 15  # Seconds between polls for a device that's changing or being controlled.
+MAX_INTERVAL = 300  # Seconds between polls for an idle device.
+UNREACHABLE_INTERVAL = 1800  # Seconds between polls for a device that isn't answering.
+MAX_IN_FLIGHT = 8  # Polls running at the same time, across all devices.
+JITTER = 0.1  # Each interval is randomly stretched or shrunk by up to this fraction.
+
+
+class PollSchedule(object):
+    """
+    Polling state for a single device.
+    """
+    def __init__(self, key, interval, next_poll):
+        self.key = key
+        self.interval = interval
+        self.next_poll = next_poll
+        self.last_status = None
+        self.failures = 0
+        self.running = False
+        self.waiting = []  # deferreds from poll_all() waiting on the next poll
+
+
+class PollScheduler(object):
+    """
+    Polls devices at adaptive intervals.
+
+    :param poll: Called as poll(key), returns the device's status (or a deferred of it), None or a
+        failure if the device didn't answer.
+    :param min_interval: Shortest time between polls of a device.
+    :param max_interval: Longest time between polls of a device that answers.
+    :param unreachable_interval: Longest time between polls of a device that doesn't answer.
+    :param max_in_flight: Polls allowed to run at once.
+    :param jitter: Fraction each interval is randomly stretched or shrunk by.
+    """
+    def __init__(self, poll, min_interval=None, max_interval=None, unreachable_interval=None,
+                 max_in_flight=None, jitter=None):
+        self.poll_function = poll
+        self.min_interval = MIN_INTERVAL if min_interval is None else min_interval
+        self.max_interval = MAX_INTERVAL if max_interval is None else max_interval
+        self.unreachable_interval = UNREACHABLE_INTERVAL if unreachable_interval is None else unreachable_interval
+        self.max_in_flight = MAX_IN_FLIGHT if max_in_flight is None else max_in_flight
+        self.jitter = JITTER if jitter is None else jitter
+
+        self.schedules = {}
+        self.queue = []  # heap of (next_poll, sequence, PollSchedule)
+        self.sequence = count()
+        self.in_flight = 0
+        self.wakeup = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self._wake()
+
+    def stop(self):
+        self.running = False
+        if self.wakeup is not None and self.wakeup.active():
+            self.wakeup.cancel()
+        self.wakeup = None
+
+    def add(self, key):
+        """
+        Start polling a device. The first poll is spread randomly over the longest interval, so
+        adding many devices at once doesn't poll them all at once.
+
+        :param key: The device key, usually the Tuya device id.
+        :return:
+        """
+        if key in self.schedules:
+            return
+        schedule = PollSchedule(key, self.max_interval, time() + random() * self.max_interval)
+        self.schedules[key] = schedule
+        self._push(schedule)
+
+    def remove(self, key):
+        schedule = self.schedules.pop(key, None)
+        if schedule is not None:
+            self._release(schedule, None)
+
+    def activity(self, key):
+        """
+        Something happened on a device, such as a status change or a command, poll it more often
+        for a while.
+
+        :param key: The device key.
+        :return:
+        """
+        schedule = self.schedules.get(key)
+        if schedule is None:
+            return
+        schedule.interval = self.min_interval
+        next_poll = time() + self._jittered(self.min_interval)
+        if next_poll < schedule.next_poll:
+            schedule.next_poll = next_poll
+            self._push(schedule)
+
+    def poll_all(self):
+        """
+        Poll every device as soon as a slot is free.
+
+        :return: Deferred that fires once every device has been polled.
+        """
+        now = time()
+        waiting = []
+        for schedule in self.schedules.values():
+            d = Deferred()
+            schedule.waiting.append(d)
+            waiting.append(d)
+            if schedule.running is False:
+                schedule.next_poll = now
+                self._push(schedule)
+        return DeferredList(waiting, consumeErrors=True)
+
+    def _jittered(self, interval):
+        return interval * uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _push(self, schedule):
+        """
+        Add a device to the heap at its next_poll time. Older heap entries for the device are skipped
+        when they come up, since their time no longer matches.
+        """
+        heappush(self.queue, (schedule.next_poll, next(self.sequence), schedule))
+        self._wake()
+
+    def _wake(self):
+        """
+        Start any due polls, then sleep until the next one is due.
+        """
+        if self.running is False:
+            return
+        if self.wakeup is not None and self.wakeup.active():
+            self.wakeup.cancel()
+        self.wakeup = None
+
+        now = time()
+        while len(self.queue) > 0 and self.in_flight < self.max_in_flight:
+            next_poll, sequence, schedule = self.queue[0]
+            if schedule.next_poll != next_poll or schedule.running or self.schedules.get(schedule.key) is not schedule:
+                heappop(self.queue)  # stale entry
+                continue
+            if next_poll > now:
+                break
+            heappop(self.queue)
+            self._poll(schedule)
+
+        if len(self.queue) > 0 and self.in_flight < self.max_in_flight:
+            self.wakeup = reactor.callLater(max(0, self.queue[0][0] - now), self._wake)
+
+    def _poll(self, schedule):
+        schedule.running = True
+        self.in_flight += 1
+        maybeDeferred(self.poll_function, schedule.key).addBoth(self._polled, schedule)
+
+    def _polled(self, result, schedule):
+        schedule.running = False
+        self.in_flight -= 1
+        if isinstance(result, Failure):
+            logger.debug("Poll of {key} failed: {error}", key=schedule.key, error=result.getErrorMessage())
+            result = None
+
+        if result is None:
+            schedule.failures += 1
+            schedule.interval = min(self.unreachable_interval, max(schedule.interval, self.min_interval) * 2)
+        else:
+            if schedule.failures == 0 and schedule.last_status is not None and result != schedule.last_status:
+                schedule.interval = self.min_interval
+            else:
+                schedule.interval = min(self.max_interval, schedule.interval * 1.5)
+            schedule.failures = 0
+            schedule.last_status = result
+
+        if self.schedules.get(schedule.key) is schedule:
+            schedule.next_poll = time() + self._jittered(schedule.interval)
+            self._push(schedule)
+        else:
+            self._wake()
+        self._release(schedule, result)
+
+    def _release(self, schedule, result):
+        waiting = schedule.waiting
+        schedule.waiting = []
+        for d in waiting:
+            d.callback(result)
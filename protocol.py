@@ -0,0 +1,391 @@
+"""
+This file was created by Yombo for use with Yombo Gateway automation
+software. Details can be found at https://yombo.net
+
+Tuya Protocol
+=============
+
+Non-blocking Twisted transport for the pytuya frame format. The pytuya library is still used to build
+and decode the frames, this only replaces the blocking sockets so that requests don't consume a thread
+from the reactor's thread pool while waiting on a device.
+
+All functions return deferreds. Timeouts are handled by the reactor and cancelling the returned
+deferred will drop the connection to the device.
+
+License
+=======
+
+See LICENSE.md for full license and attribution information.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+:license: Apache 2.0
+"""
+# Import twisted libraries
+from twisted.internet import error, reactor
+from twisted.internet.defer import CancelledError, Deferred, fail
+from twisted.internet.error import ConnectError, ConnectionDone, ConnectionLost, TimeoutError
+from twisted.internet.protocol import ClientFactory, Protocol, ReconnectingClientFactory
+from twisted.internet.task import LoopingCall
+from twisted.python.failure import Failure
+
+from yombo.core.log import get_logger
+
+from . import pytuya
+
+logger = get_logger("modules.tuya.protocol")
+
+DEFAULT_PORT = 6668
+DEFAULT_TIMEOUT = 5
+HEARTBEAT_INTERVAL = 10  # Seconds between heartbeats on a listener, the devices drop idle connections.
+MAX_MISSED_HEARTBEATS = 3  # Heartbeats in a row without a reply before the connection is considered dead.
+PUSH_COMMAND = 0x08  # Status update sent by the device on its own, such as when the button is pressed.
+
+# Errors that mean the device couldn't be reached or dropped us, callers typically retry on these.
+NETWORK_ERRORS = (ConnectError, ConnectionDone, ConnectionLost, TimeoutError)
+
+# Errors that simply mean nothing is listening at the address. TimeoutError and cancellations are UserErrors.
+PORT_CLOSED_ERRORS = (error.ConnectionRefusedError, error.NoRouteError, error.TCPTimedOutError, error.UserError)
+
+
+class TuyaClientProtocol(Protocol):
+    """
+    Decodes incoming data into frames (pytuya.TuyaMessage) and hands each one to the factory.
+    """
+    def __init__(self):
+        self.decoder = pytuya.FrameDecoder()
+
+    def connectionMade(self):
+        self.transport.setTcpNoDelay(True)
+        self.factory.connection_made(self)
+
+    def dataReceived(self, data):
+        for message in self.decoder.feed(data):
+            self.factory.frame_received(self, message)
+
+    def connectionLost(self, reason):
+        self.factory.connection_lost(self, reason)
+
+
+class TuyaRequestFactory(ClientFactory):
+    """
+    Connects to a device, sends a single payload and fires the deferred with the reply.
+    """
+    protocol = TuyaClientProtocol
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.command = pytuya.frame_command(payload)
+        self.deferred = Deferred(self._cancel)
+        self.connector = None
+        self.client = None
+
+    def _cancel(self, deferred):
+        """
+        Called when the deferred is cancelled, either by the caller or the timeout.
+        """
+        if self.client is not None:
+            self.client.transport.abortConnection()
+        elif self.connector is not None:
+            self.connector.disconnect()
+
+    def connection_made(self, client):
+        self.client = client
+        client.transport.write(self.payload)
+
+    def frame_received(self, client, message):
+        if message.cmd != self.command:
+            logger.debug("Skipping unexpected frame: {message}", message=message)
+            return
+        if self.deferred.called is False:
+            self.deferred.callback(message)
+        client.transport.loseConnection()
+
+    def connection_lost(self, client, reason):
+        self.client = None
+        if self.deferred.called is False:
+            self.deferred.errback(reason)
+
+    def clientConnectionFailed(self, connector, reason):
+        if self.deferred.called is False:
+            self.deferred.errback(reason)
+
+
+class PortProbeProtocol(Protocol):
+    """
+    Hangs up as soon as the connection is made.
+    """
+    def connectionMade(self):
+        self.factory.port_open()
+        self.transport.loseConnection()
+
+
+class PortProbeFactory(ClientFactory):
+    """
+    Only checks if a TCP port is accepting connections. The deferred fires with True or False, or errbacks
+    for errors that aren't from the remote side, such as running out of sockets.
+    """
+    protocol = PortProbeProtocol
+
+    def __init__(self):
+        self.deferred = Deferred(self._cancel)
+        self.connector = None
+
+    def _cancel(self, deferred):
+        if self.connector is not None:
+            self.connector.disconnect()
+
+    def port_open(self):
+        if self.deferred.called is False:
+            self.deferred.callback(True)
+
+    def clientConnectionFailed(self, connector, reason):
+        if self.deferred.called is False:
+            if reason.check(*PORT_CLOSED_ERRORS):
+                self.deferred.callback(False)
+            else:
+                self.deferred.errback(reason)
+
+
+class TuyaListenerFactory(ReconnectingClientFactory):
+    """
+    Keeps a connection open to a device so it can push status updates (PUSH_COMMAND frames) as
+    they happen. Each push is handed to push_callback(message) as a pytuya.TuyaMessage.
+
+    The devices only accept one connection at a time, so while the listener is connected every
+    request for the device must be sent through it with request(). Replies are matched to
+    requests by command, in order. The connection is re-established with an increasing delay
+    whenever it's lost, or when the device stops answering heartbeats, so a half open connection
+    isn't reported as connected.
+
+    :param push_callback: Called with every status update pushed by the device.
+    :param heartbeat_payload: Frame sent while idle to keep the connection open.
+    :param heartbeat_interval: Seconds between heartbeats.
+    """
+    protocol = TuyaClientProtocol
+    initialDelay = 1
+    maxDelay = 60
+
+    def __init__(self, push_callback, heartbeat_payload, heartbeat_interval=None):
+        if heartbeat_interval is None:
+            heartbeat_interval = HEARTBEAT_INTERVAL
+        self.push_callback = push_callback
+        self.heartbeat_payload = heartbeat_payload
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_command = pytuya.frame_command(heartbeat_payload)
+        self.heartbeat = None
+        self.missed_heartbeats = 0  # heartbeats sent since the device last sent anything
+        self.connector = None
+        self.client = None
+        self.pending = []  # (command, deferred) for requests waiting on a reply, oldest first
+
+    @property
+    def connected(self):
+        return self.client is not None
+
+    def request(self, payload, timeout=None):
+        """
+        Send a frame over the open connection.
+
+        :param payload: Bytes to send, usually from XenonDevice.generate_payload().
+        :param timeout: Seconds to wait for the reply.
+        :return: Deferred that fires with the reply, a pytuya.TuyaMessage.
+        """
+        if self.client is None:
+            return fail(ConnectError("Listener is not connected."))
+        if timeout is None:
+            timeout = DEFAULT_TIMEOUT
+        d = Deferred(self._cancel)
+        self.pending.append((pytuya.frame_command(payload), d))
+        self.client.transport.write(payload)
+        d.addTimeout(timeout, reactor, onTimeoutCancel=_timed_out)
+        return d
+
+    def _cancel(self, deferred):
+        """
+        A request was cancelled or timed out. Any late reply would be matched to the wrong request,
+        so the connection is dropped and re-established.
+        """
+        self.pending = [item for item in self.pending if item[1] is not deferred]
+        if self.client is not None:
+            self.client.transport.abortConnection()
+
+    def connection_made(self, client):
+        self.resetDelay()
+        self.client = client
+        self.missed_heartbeats = 0
+        self.heartbeat = LoopingCall(self._send_heartbeat)
+        self.heartbeat.start(self.heartbeat_interval, now=False)
+
+    def _send_heartbeat(self):
+        if self.client is None or len(self.pending) > 0:
+            return
+        if self.missed_heartbeats >= MAX_MISSED_HEARTBEATS:
+            logger.info("Device stopped answering heartbeats, reconnecting.")
+            self.client.transport.abortConnection()
+            return
+        self.missed_heartbeats += 1
+        self.client.transport.write(self.heartbeat_payload)
+
+    def frame_received(self, client, message):
+        self.missed_heartbeats = 0  # anything from the device shows the connection is alive
+        if len(self.pending) > 0 and self.pending[0][0] == message.cmd:
+            command, d = self.pending.pop(0)
+            if d.called is False:
+                d.callback(message)
+        elif message.cmd == PUSH_COMMAND:
+            self.push_callback(message)
+        elif message.cmd == self.heartbeat_command:
+            pass
+        else:
+            logger.debug("Skipping unexpected frame: {message}", message=message)
+
+    def connection_lost(self, client, reason):
+        self.client = None
+        if self.heartbeat is not None and self.heartbeat.running:
+            self.heartbeat.stop()
+        self.heartbeat = None
+        pending = self.pending
+        self.pending = []
+        for command, d in pending:
+            if d.called is False:
+                d.errback(reason)
+
+    def stop(self):
+        """
+        Close the connection and stop reconnecting.
+        """
+        self.stopTrying()
+        if self.client is not None:
+            self.client.transport.loseConnection()
+        elif self.connector is not None:
+            self.connector.disconnect()
+
+
+def listen(tuya_device, push_callback, heartbeat_interval=None):
+    """
+    Open a long lived connection to a device to receive the status updates it pushes.
+
+    :param tuya_device: A pytuya.Device instance.
+    :param push_callback: Called with every pushed pytuya.TuyaMessage, tuya_device.parse_status() decodes it.
+    :param heartbeat_interval: Seconds between heartbeats.
+    :return: The TuyaListenerFactory, call stop() on it to close the connection.
+    """
+    factory = TuyaListenerFactory(push_callback, tuya_device.generate_payload(pytuya.HEART_BEAT), heartbeat_interval)
+    factory.connector = reactor.connectTCP(tuya_device.address, tuya_device.port, factory, timeout=DEFAULT_TIMEOUT)
+    return factory
+
+
+def send_receive(address, payload, port=None, timeout=None):
+    """
+    Send a single frame to a device and return a deferred that fires with the reply, a pytuya.TuyaMessage.
+
+    :param address: IP address of the device.
+    :param payload: Bytes to send, usually from XenonDevice.generate_payload().
+    :param port: Port to connect to, defaults to 6668.
+    :param timeout: Seconds to wait for the entire exchange.
+    :return: Deferred
+    """
+    if port is None:
+        port = DEFAULT_PORT
+    if timeout is None:
+        timeout = DEFAULT_TIMEOUT
+    factory = TuyaRequestFactory(payload)
+    factory.connector = reactor.connectTCP(address, port, factory, timeout=timeout)
+    factory.deferred.addTimeout(timeout, reactor, onTimeoutCancel=_timed_out)
+    return factory.deferred
+
+
+def probe_port(address, port=None, timeout=None):
+    """
+    Check if a device is listening on the given port.
+
+    :param address: IP address to check.
+    :param port: Port to check, defaults to 6668.
+    :param timeout: Seconds to wait for the connection.
+    :return: Deferred that fires with True or False. Local errors, such as running out of sockets, errback.
+    """
+    if port is None:
+        port = DEFAULT_PORT
+    if timeout is None:
+        timeout = DEFAULT_TIMEOUT
+    factory = PortProbeFactory()
+    factory.connector = reactor.connectTCP(address, port, factory, timeout=timeout)
+    factory.deferred.addTimeout(timeout, reactor, onTimeoutCancel=_timed_out)
+    factory.deferred.addErrback(_probe_timed_out)
+    return factory.deferred
+
+
+def _timed_out(result, timeout):
+    """
+    Called by addTimeout() when a deferred timed out. Raises the same TimeoutError as a connection
+    attempt that timed out, instead of twisted.internet.defer.TimeoutError, so callers only have
+    one to handle.
+    """
+    if isinstance(result, Failure) and result.check(CancelledError):
+        raise TimeoutError(string="No reply within %s seconds." % timeout)
+    return result
+
+
+def _probe_timed_out(failure):
+    failure.trap(TimeoutError)
+    return False
+
+
+def request(tuya_device, payload, timeout=None, listener=None):
+    """
+    Send a frame through the device's listener if it's connected, otherwise over a new connection.
+
+    :param tuya_device: A pytuya.Device instance.
+    :param payload: Bytes to send.
+    :param timeout: Seconds to wait for the reply.
+    :param listener: The device's TuyaListenerFactory, if any.
+    :return: Deferred that fires with the reply, a pytuya.TuyaMessage.
+    """
+    if listener is not None and listener.connected:
+        return listener.request(payload, timeout)
+    return send_receive(tuya_device.address, payload, tuya_device.port, timeout)
+
+
+def status(tuya_device, timeout=None, listener=None):
+    """
+    Non-blocking version of pytuya.Device.status().
+
+    :param tuya_device: A pytuya.Device instance.
+    :param timeout: Seconds to wait for the reply.
+    :param listener: The device's TuyaListenerFactory, if any.
+    :return: Deferred that fires with the decoded status.
+    """
+    payload = tuya_device.generate_payload('status')
+    d = request(tuya_device, payload, timeout, listener)
+    d.addCallback(tuya_device.parse_status)
+    return d
+
+
+def set_status(tuya_device, on, switch=1, timeout=None, listener=None):
+    """
+    Non-blocking version of pytuya.Device.set_status().
+
+    :param tuya_device: A pytuya.Device instance.
+    :param on: True for on, False for off.
+    :param switch: The switch (dps) to set.
+    :param timeout: Seconds to wait for the reply.
+    :param listener: The device's TuyaListenerFactory, if any.
+    :return: Deferred that fires with the reply, a pytuya.TuyaMessage.
+    """
+    if isinstance(switch, int):
+        switch = str(switch)
+    return set_dps(tuya_device, {switch: on}, timeout, listener)
+
+
+def set_dps(tuya_device, dps, timeout=None, listener=None):
+    """
+    Set any number of dps values with a single SET frame.
+
+    :param tuya_device: A pytuya.Device instance.
+    :param dps: Dictionary of dps index (string) -> value.
+    :param timeout: Seconds to wait for the reply.
+    :param listener: The device's TuyaListenerFactory, if any.
+    :return: Deferred that fires with the reply, a pytuya.TuyaMessage.
+    """
+    payload = tuya_device.generate_payload(pytuya.SET, dps)
+    return request(tuya_device, payload, timeout, listener)
@@ -10,84 +10,186 @@
 
 
 import base64
+from collections import namedtuple
 from hashlib import md5
 import json
 import logging
 import socket
+import struct
 import sys
+import threading
 import time
 import colorsys
+from itertools import count
+import zlib
 
+# Crypto backends, in order of preference. At least one of these is required.
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes  # cryptography
+except ImportError:
+    Cipher = None
 try:
-    # raise ImportError
     import Crypto
-    from Crypto.Cipher import AES  # PyCrypto
+    from Crypto.Cipher import AES  # pycryptodome or PyCrypto
 except ImportError:
     Crypto = AES = None
+try:
     import pyaes  # https://github.com/ricmoo/pyaes
+except ImportError:
+    pyaes = None
 
 log = logging.getLogger(__name__)
 logging.basicConfig()  # TODO include function name/line numbers in log
 # log.setLevel(level=logging.DEBUG)  # Debug hack!
 
 log.info('Python %s on %s', sys.version, sys.platform)
-if Crypto is None:
-    log.info('Using pyaes version %r', pyaes.VERSION)
-    log.info('Using pyaes from %r', pyaes.__file__)
-else:
-    log.info('Using PyCrypto %r', Crypto.version_info)
-    log.info('Using PyCrypto from %r', Crypto.__file__)
 
 SET = 'set'
+HEART_BEAT = 'heartbeat'
 
 PROTOCOL_VERSION_BYTES = b'3.1'
 
 IS_PY2 = sys.version_info[0] == 2
 
+PREFIX = 0x000055aa
+PREFIX_BYTES = b'\x00\x00\x55\xaa'
+SUFFIX = 0x0000aa55
+HEADER_FORMAT = '>4I'  # prefix, sequence number, command, length
+HEADER_SIZE = 16
+FOOTER_FORMAT = '>2I'  # crc32, suffix
+FOOTER_SIZE = 8
+MAX_FRAME_SIZE = 0xffff  # anything larger is garbage, not a real frame
+
+TuyaMessage = namedtuple('TuyaMessage', 'seqno cmd retcode payload crc')
+
+
+class CryptographyBackend(object):
+    name = 'cryptography'
+
+    def __init__(self, key):
+        """
+        AES-128-ECB using the cryptography package. The Cipher (and its key schedule) is kept for
+        the life of the backend, a new context is made for every call. A shared context would
+        hold on to the tail of any input that isn't a whole number of blocks, and every later
+        call would come out shifted.
+        """
+        self._cipher = Cipher(algorithms.AES(key), modes.ECB(), backend=default_backend())
+
+    def encrypt(self, data):
+        encryptor = self._cipher.encryptor()
+        return encryptor.update(data) + encryptor.finalize()
+
+    def decrypt(self, data):
+        decryptor = self._cipher.decryptor()
+        return decryptor.update(data) + decryptor.finalize()  # finalize() raises ValueError for partial blocks
+
+
+class PyCryptoBackend(object):
+    name = 'pycrypto'
+
+    def __init__(self, key):
+        """
+        AES-128-ECB using pycryptodome or PyCrypto.
+        """
+        self._cipher = AES.new(key, AES.MODE_ECB)
+
+    def encrypt(self, data):
+        return self._cipher.encrypt(bytes(data))
+
+    def decrypt(self, data):
+        return self._cipher.decrypt(bytes(data))
+
+
+class PyaesBackend(object):
+    name = 'pyaes'
+
+    def __init__(self, key):
+        """
+        AES-128-ECB in pure python, very slow. Only used if nothing else is installed.
+        """
+        self._cipher = pyaes.AESModeOfOperationECB(key)
+
+    def encrypt(self, data):
+        encrypt = self._cipher.encrypt
+        return b''.join(encrypt(data[i:i + 16]) for i in range(0, len(data), 16))
+
+    def decrypt(self, data):
+        decrypt = self._cipher.decrypt
+        return b''.join(decrypt(data[i:i + 16]) for i in range(0, len(data), 16))
+
+
+BACKENDS = []  # Available backends, best first.
+if Cipher is not None:
+    BACKENDS.append(CryptographyBackend)
+if AES is not None:
+    BACKENDS.append(PyCryptoBackend)
+if pyaes is not None:
+    BACKENDS.append(PyaesBackend)
+if len(BACKENDS) == 0:
+    raise ImportError('pytuya requires one of: cryptography, pycryptodome, PyCrypto or pyaes')
+
+_backend = BACKENDS[0]
+_ciphers = {}  # local_key -> backend instance
+_ciphers_lock = threading.Lock()
+log.info('Using crypto backend: %s', _backend.name)
+
+
+def set_backend(name):
+    """
+    Select the crypto backend by name, mostly useful for benchmarking. Clears the cipher cache.
+
+    Args:
+        name (str): One of 'cryptography', 'pycrypto' or 'pyaes'.
+    """
+    global _backend
+    for backend in BACKENDS:
+        if backend.name == name:
+            with _ciphers_lock:
+                _backend = backend
+                _ciphers.clear()
+            return
+    raise ValueError('Crypto backend not available: %s' % name)
+
+
+def get_cipher(key):
+    """
+    Get the cached cipher for a key, creating it the first time. Key expansion is done once per
+    key instead of for every frame.
+
+    Args:
+        key (bytes): The encryption key.
+    """
+    cipher = _ciphers.get(key)
+    if cipher is None:
+        with _ciphers_lock:
+            cipher = _ciphers.get(key)
+            if cipher is None:
+                cipher = _backend(key)
+                _ciphers[key] = cipher
+    return cipher
+
 
 class AESCipher(object):
     def __init__(self, key):
         # self.bs = 32  # 32 work fines for ON, does not work for OFF. Padding different compared to js version https://github.com/codetheweb/tuyapi/
         self.bs = 16
         self.key = key
+        self.cipher = get_cipher(key)
 
     def encrypt(self, raw):
-        if Crypto:
-            raw = self._pad(raw)
-            cipher = AES.new(self.key, mode=AES.MODE_ECB)
-            crypted_text = cipher.encrypt(raw)
-        else:
-            _ = self._pad(raw)
-            cipher = pyaes.blockfeeder.Encrypter(pyaes.AESModeOfOperationECB(self.key))  # no IV, auto pads to 16
-            crypted_text = cipher.feed(raw)
-            crypted_text += cipher.feed()  # flush final block
-        # print('crypted_text %r' % crypted_text)
-        # print('crypted_text (%d) %r' % (len(crypted_text), crypted_text))
-        crypted_text_b64 = base64.b64encode(crypted_text)
-        # print('crypted_text_b64 (%d) %r' % (len(crypted_text_b64), crypted_text_b64))
-        return crypted_text_b64
-
-    def decrypt(self, enc):
-        enc = base64.b64decode(enc)
-        # print('enc (%d) %r' % (len(enc), enc))
-        # enc = self._unpad(enc)
-        # enc = self._pad(enc)
-        # print('upadenc (%d) %r' % (len(enc), enc))
-        if Crypto:
-            cipher = AES.new(self.key, AES.MODE_ECB)
-            raw = cipher.decrypt(enc)
-            # print('raw (%d) %r' % (len(raw), raw))
-            return self._unpad(raw).decode('utf-8')
-            # return self._unpad(cipher.decrypt(enc)).decode('utf-8')
-        else:
-            cipher = pyaes.blockfeeder.Decrypter(pyaes.AESModeOfOperationECB(self.key))  # no IV, auto pads to 16
-            plain_text = cipher.feed(enc)
-            plain_text += cipher.feed()  # flush final block
-            return plain_text
+        crypted_text = self.cipher.encrypt(self._pad(raw))
+        return base64.b64encode(crypted_text)
+
+    def decrypt(self, enc, use_base64=True):
+        if use_base64:
+            enc = base64.b64decode(enc)
+        raw = self.cipher.decrypt(enc)
+        return self._unpad(raw).decode('utf-8')
 
     def _pad(self, s):
         padnum = self.bs - len(s) % self.bs
-        return s + padnum * chr(padnum).encode()
+        return bytes(s) + padnum * chr(padnum).encode()
 
     @staticmethod
     def _unpad(s):
@@ -113,6 +215,114 @@ def hex2bin(x):
         return bytes.fromhex(x)
 
 
+class FrameDecoder(object):
+    def __init__(self, validate_crc=True):
+        """
+        Incremental decoder for the frames sent by devices. Feed it whatever was read from
+        the socket, in any size chunks, and it returns the complete frames found so far.
+        Partial frames are kept until the rest arrives.
+
+        Frame layout: prefix, sequence number, command, length (4 bytes each), an optional
+        4 byte return code, the payload, crc32 and suffix (4 bytes each). The length covers
+        everything after the length field.
+
+        Args:
+            validate_crc (bool, optional): Drop frames with a bad crc32. Defaults to True.
+        """
+        self.validate_crc = validate_crc
+        self.buffer = bytearray()
+
+    def reset(self):
+        del self.buffer[:]
+
+    def feed(self, data):
+        """
+        Add received data and return a list of TuyaMessage for every complete frame.
+
+        Args:
+            data(bytes): Bytes read from the device.
+        """
+        buffer = self.buffer
+        buffer.extend(data)
+        messages = []
+        offset = 0
+        view = memoryview(buffer)
+        try:
+            while len(buffer) - offset >= HEADER_SIZE:
+                prefix, seqno, cmd, length = struct.unpack_from(HEADER_FORMAT, buffer, offset)
+                if prefix != PREFIX:
+                    # Out of sync, skip ahead to the next prefix. Keep a few bytes in case it's split.
+                    index = buffer.find(PREFIX_BYTES, offset + 1)
+                    if index == -1:
+                        offset = len(buffer) - len(PREFIX_BYTES) + 1
+                        break
+                    log.debug('Skipping %d bytes of garbage', index - offset)
+                    offset = index
+                    continue
+                if length < FOOTER_SIZE or length > MAX_FRAME_SIZE:
+                    log.warning('Invalid frame length %d, resyncing', length)
+                    offset += len(PREFIX_BYTES)
+                    continue
+                end = offset + HEADER_SIZE + length
+                if end > len(buffer):
+                    break  # wait for the rest of the frame
+                crc, suffix = struct.unpack_from(FOOTER_FORMAT, buffer, end - FOOTER_SIZE)
+                if suffix != SUFFIX:
+                    log.warning('Invalid frame suffix %08x, resyncing', suffix)
+                    offset += len(PREFIX_BYTES)
+                    continue
+                if self.validate_crc and zlib.crc32(view[offset:end - FOOTER_SIZE]) & 0xffffffff != crc:
+                    log.warning('Dropping frame with bad crc, command %d', cmd)
+                    offset = end
+                    continue
+
+                start = offset + HEADER_SIZE
+                retcode = None
+                if end - FOOTER_SIZE - start >= 4:
+                    value = struct.unpack_from('>I', buffer, start)[0]
+                    if value & 0xffffff00 == 0:  # payloads start with '{' or the version, never a null byte
+                        retcode = value
+                        start += 4
+                messages.append(TuyaMessage(seqno, cmd, retcode, bytes(view[start:end - FOOTER_SIZE]), crc))
+                offset = end
+        finally:
+            if not IS_PY2:
+                view.release()
+        if offset:
+            del buffer[:offset]
+        return messages
+
+
+def frame_command(frame):
+    """
+    Get the command number out of a frame built by XenonDevice.generate_payload().
+
+    Args:
+        frame(bytes): A complete frame.
+    """
+    return struct.unpack_from(HEADER_FORMAT, frame)[2]
+
+
+def receive_message(s, decoder, command):
+    """
+    Read from a blocking socket until a reply for `command` is decoded. Frames for other commands,
+    such as status updates pushed by the device, are skipped.
+
+    Args:
+        s(socket): Connected socket.
+        decoder(FrameDecoder): Decoder for this connection.
+        command(int): The command number of the request.
+    """
+    while True:
+        data = s.recv(4096)
+        if not data:
+            raise socket.error('Connection closed by device')
+        for message in decoder.feed(data):
+            if message.cmd == command:
+                return message
+            log.debug('Skipping unexpected frame: %r', message)
+
+
 # This is intended to match requests.json payload at https://github.com/codetheweb/tuyapi
 payload_dict = {
     "device": {
@@ -124,6 +334,10 @@ payload_dict = {
             "hexByte": "07",
             "command": {"devId": "", "uid": "", "t": ""}
         },
+        "heartbeat": {
+            "hexByte": "09",
+            "command": {"gwId": "", "devId": ""}
+        },
         "prefix": "000055aa00000000000000",
     # Next byte is command byte ("hexByte") some zero padding, then length of remaining payload, i.e. command + suffix (unclear if multiple bytes used for length, zero padding implies could be more than one byte)
         "suffix": "000000000000aa55"
@@ -131,8 +345,332 @@ payload_dict = {
 }
 
 
+_command_tables = {}  # dev_type -> command -> (command number, json template)
+
+
+class FrameEncoder(object):
+    def __init__(self, dev_id, local_key, dev_type):
+        """
+        Builds the frames sent to a device. The templates in payload_dict are only read, never
+        changed, so one encoder (or many) can be used from several threads at once.
+
+        Everything that doesn't change between frames is computed once: the json for commands
+        without a timestamp or dps (status and heartbeat), and the tail of the string that's
+        signed for SET commands.
+
+        Frame layout: prefix, sequence number, command, length (4 bytes each), the payload,
+        crc32 and suffix (4 bytes each). The length covers the payload and the last 8 bytes.
+
+        Args:
+            dev_id (str): The device id.
+            local_key (bytes): The encryption key.
+            dev_type (str): Key for lookups in payload_dict.
+        """
+        self.dev_id = dev_id
+        self.local_key = local_key
+        self.dev_type = dev_type
+        self.commands = _command_tables.get(dev_type)
+        if self.commands is None:
+            self.commands = {}
+            for command, details in payload_dict.get(dev_type, {}).items():
+                if isinstance(details, dict):
+                    self.commands[command] = (int(details['hexByte'], 16), details['command'])
+            _command_tables[dev_type] = self.commands  # shared by every encoder of this type
+        self._static_payloads = {}
+        self._signature_suffix = b'||lpv=' + PROTOCOL_VERSION_BYTES + b'||' + local_key
+        self._sequence = count(1)
+
+    def encode_json(self, command, data=None):
+        """
+        Build the json payload for a command, before any encryption.
+
+        Args:
+            command(str): The type of command.
+            data(dict, optional): The dps to send.
+        """
+        template = self.commands[command][1]
+        if data is None and 't' not in template:
+            payload = self._static_payloads.get(command)
+            if payload is not None:
+                return payload
+
+        json_data = {}
+        for key in template:
+            if key == 't':
+                json_data[key] = str(int(time.time()))
+            else:
+                json_data[key] = self.dev_id  # gwId, devId and uid are all the device id
+        if data is not None:
+            json_data['dps'] = data
+        # compact separators, if there are spaces between items the device does not respond!
+        payload = json.dumps(json_data, separators=(',', ':')).encode('utf-8')
+        log.debug('json_payload=%r', payload)
+
+        if data is None and 't' not in template:
+            self._static_payloads[command] = payload
+        return payload
+
+    def encode(self, command, data=None, seqno=None):
+        """
+        Build a complete frame.
+
+        Args:
+            command(str): The type of command.
+            data(dict, optional): The dps to send.
+            seqno(int, optional): Sequence number, defaults to the next one for this encoder.
+        """
+        command_number = self.commands[command][0]
+        payload = self.encode_json(command, data)
+        if command == SET:
+            payload = self.sign(AESCipher(self.local_key).encrypt(payload))
+        if seqno is None:
+            seqno = next(self._sequence) & 0xffffffff
+
+        payload_size = len(payload)
+        frame = bytearray(HEADER_SIZE + payload_size + FOOTER_SIZE)
+        struct.pack_into(HEADER_FORMAT, frame, 0, PREFIX, seqno, command_number, payload_size + FOOTER_SIZE)
+        frame[HEADER_SIZE:HEADER_SIZE + payload_size] = payload
+        crc = zlib.crc32(memoryview(frame)[:HEADER_SIZE + payload_size]) & 0xffffffff
+        struct.pack_into(FOOTER_FORMAT, frame, HEADER_SIZE + payload_size, crc, SUFFIX)
+        return bytes(frame)
+
+    def sign(self, encrypted):
+        """
+        Add the protocol version and signature to an encrypted payload.
+
+        Args:
+            encrypted(bytes): Base64 encoded, encrypted json.
+        """
+        hexdigest = md5(b'data=' + encrypted + self._signature_suffix).hexdigest()
+        return PROTOCOL_VERSION_BYTES + hexdigest[8:24].encode('latin1') + encrypted
+
+
+class Connection(object):
+    def __init__(self, address, port, connection_timeout, heartbeat_payload):
+        """
+        A long lived socket to a single device. All access is serialized with a lock
+        since the devices can only handle one request at a time.
+
+        Args:
+            address (str): The network address.
+            port (int): The port to connect to.
+            connection_timeout (int): Socket timeout in seconds.
+            heartbeat_payload (bytes): Frame sent to keep the connection alive.
+        """
+        self.address = address
+        self.port = port
+        self.connection_timeout = connection_timeout
+        self.heartbeat_payload = heartbeat_payload
+        self.lock = threading.RLock()
+        self.decoder = FrameDecoder()
+        self.socket = None
+        self.last_used = 0
+        self.failures = 0
+        self.next_attempt = 0
+
+    def __repr__(self):
+        return 'Connection(%r)' % ((self.address, self.port),)
+
+    def connect(self):
+        """
+        Open the socket if it's not already open.
+        """
+        with self.lock:
+            if self.socket is not None:
+                return self.socket
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            s.settimeout(self.connection_timeout)
+            try:
+                s.connect((self.address, self.port))
+            except socket.error:
+                s.close()
+                self._backoff()
+                raise
+            self.socket = s
+            self.decoder.reset()
+            self.failures = 0
+            self.next_attempt = 0
+            self.last_used = time.time()
+            return s
+
+    def close(self):
+        with self.lock:
+            if self.socket is None:
+                return
+            try:
+                self.socket.close()
+            except socket.error:
+                pass
+            self.socket = None
+
+    def _backoff(self):
+        """
+        Delay the next background reconnect, doubling each time up to MAX_BACKOFF.
+        """
+        self.failures += 1
+        delay = min(ConnectionPool.MAX_BACKOFF, ConnectionPool.MIN_BACKOFF * 2 ** (self.failures - 1))
+        self.next_attempt = time.time() + delay
+
+    def _drain(self, s):
+        """
+        Discard any frames the device sent while we weren't waiting for a reply.
+        """
+        s.setblocking(0)
+        try:
+            while True:
+                data = s.recv(4096)
+                if not data:
+                    break
+                self.decoder.feed(data)
+        except socket.error:
+            pass
+        finally:
+            s.settimeout(self.connection_timeout)
+
+    def send_receive(self, payload):
+        """
+        Send single buffer `payload` and return the reply as a TuyaMessage. If the existing socket has
+        gone stale, it's reopened and the payload is sent once more.
+
+        Args:
+            payload(bytes): Data to send.
+        """
+        command = frame_command(payload)
+        with self.lock:
+            reused = self.socket is not None
+            while True:
+                s = self.connect()
+                try:
+                    self._drain(s)
+                    s.sendall(payload)
+                    message = receive_message(s, self.decoder, command)
+                except socket.error:
+                    self.close()
+                    if reused is False:
+                        raise
+                    reused = False
+                    continue
+                self.last_used = time.time()
+                return message
+
+    def maintain(self, heartbeat_interval):
+        """
+        Called periodically by the pool. Sends a heartbeat when the connection has been idle, and
+        reconnects dropped connections once the backoff delay has passed.
+        """
+        if not self.lock.acquire(False):
+            return  # busy, so it's obviously alive
+        try:
+            now = time.time()
+            if self.socket is None:
+                if now >= self.next_attempt:
+                    try:
+                        self.connect()
+                    except socket.error as e:
+                        log.debug('reconnect to %r failed: %s', self, e)
+                return
+            if now - self.last_used < heartbeat_interval:
+                return
+            try:
+                self.send_receive(self.heartbeat_payload)
+            except socket.error as e:
+                log.debug('heartbeat to %r failed: %s', self, e)
+                if self.next_attempt <= now:
+                    self._backoff()
+        finally:
+            self.lock.release()
+
+
+class ConnectionPool(object):
+    MIN_BACKOFF = 1
+    MAX_BACKOFF = 60
+
+    def __init__(self, heartbeat_interval=10):
+        """
+        Keeps one long lived connection per device and a background thread that sends heartbeats
+        and reconnects dropped connections.
+
+        NOTE: Devices only accept a single connection, so a pooled device can't be used by the
+        Tuya/Jinvoo apps at the same time.
+
+        Args:
+            heartbeat_interval (int): Seconds a connection may sit idle before a heartbeat is sent.
+        """
+        self.heartbeat_interval = heartbeat_interval
+        self.connections = {}
+        self.lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def get(self, device):
+        """
+        Get the connection for a device, creating it if needed.
+
+        Args:
+            device (XenonDevice): The device to get a connection for.
+        """
+        key = (device.address, device.port)
+        with self.lock:
+            connection = self.connections.get(key)
+            if connection is None:
+                connection = Connection(device.address, device.port, device.connection_timeout,
+                                        device.generate_payload(HEART_BEAT))
+                self.connections[key] = connection
+            if self._thread is None:
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name='pytuya-heartbeat')
+                self._thread.daemon = True
+                self._thread.start()
+        return connection
+
+    def remove(self, device):
+        with self.lock:
+            connection = self.connections.pop((device.address, device.port), None)
+        if connection is not None:
+            connection.close()
+
+    def close(self):
+        """
+        Stop the heartbeat thread and close all connections.
+        """
+        self._stopping.set()
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+            thread = self._thread
+            self._thread = None
+        for connection in connections:
+            connection.close()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self):
+        while not self._stopping.wait(1):
+            with self.lock:
+                connections = list(self.connections.values())
+            for connection in connections:
+                connection.maintain(self.heartbeat_interval)
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool():
+    """
+    The pool used by devices created with persistent=True.
+    """
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConnectionPool()
+        return _default_pool
+
+
 class XenonDevice(object):
-    def __init__(self, dev_id, address, local_key=None, dev_type=None, connection_timeout=10):
+    def __init__(self, dev_id, address, local_key=None, dev_type=None, connection_timeout=10, persistent=False):
         """
         Represents a Tuya device.
 
@@ -143,6 +681,8 @@ class XenonDevice(object):
             dev_type (str, optional): The device type.
                 It will be used as key for lookups in payload_dict.
                 Defaults to None.
+            persistent (bool, optional): Keep the connection open between requests, using
+                the default ConnectionPool. Defaults to False.
 
         Attributes:
             port (int): The port to connect to.
@@ -153,6 +693,8 @@ class XenonDevice(object):
         self.local_key = local_key.encode('latin1')
         self.dev_type = dev_type
         self.connection_timeout = connection_timeout
+        self.persistent = persistent
+        self.encoder = FrameEncoder(dev_id, self.local_key, dev_type)
 
         self.port = 6668  # default - do not expect caller to pass in
 
@@ -161,19 +703,25 @@ class XenonDevice(object):
 
     def _send_receive(self, payload):
         """
-        Send single buffer `payload` and receive a single buffer.
+        Send single buffer `payload` and receive the reply.
 
         Args:
             payload(bytes): Data to send.
+
+        Returns:
+            TuyaMessage: The decoded reply.
         """
+        if self.persistent:
+            return get_default_pool().get(self).send_receive(payload)
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         s.settimeout(self.connection_timeout)
-        s.connect((self.address, self.port))
-        s.send(payload)
-        data = s.recv(1024)
-        s.close()
-        return data
+        try:
+            s.connect((self.address, self.port))
+            s.sendall(payload)
+            return receive_message(s, FrameDecoder(), frame_command(payload))
+        finally:
+            s.close()
 
     def generate_payload(self, command, data=None):
         """
@@ -185,74 +733,12 @@ class XenonDevice(object):
             data(dict, optional): The data to be send.
                 This is what will be passed via the 'dps' entry
         """
-        json_data = payload_dict[self.dev_type][command]['command']
-
-        if 'gwId' in json_data:
-            json_data['gwId'] = self.id
-        if 'devId' in json_data:
-            json_data['devId'] = self.id
-        if 'uid' in json_data:
-            json_data['uid'] = self.id  # still use id, no seperate uid
-        if 't' in json_data:
-            json_data['t'] = str(int(time.time()))
-
-        if data is not None:
-            json_data['dps'] = data
-
-        # Create byte buffer from hex data
-        json_payload = json.dumps(json_data)
-        # print(json_payload)
-        json_payload = json_payload.replace(' ', '')  # if spaces are not removed device does not respond!
-        json_payload = json_payload.encode('utf-8')
-        log.debug('json_payload=%r', json_payload)
-
-        if command == SET:
-            # need to encrypt
-            # print('json_payload %r' % json_payload)
-            self.cipher = AESCipher(self.local_key)  # expect to connect and then disconnect to set new
-            json_payload = self.cipher.encrypt(json_payload)
-            # print('crypted json_payload %r' % json_payload)
-            preMd5String = b'data=' + json_payload + b'||lpv=' + PROTOCOL_VERSION_BYTES + b'||' + self.local_key
-            # print('preMd5String %r' % preMd5String)
-            m = md5()
-            m.update(preMd5String)
-            # print(repr(m.digest()))
-            hexdigest = m.hexdigest()
-            # print(hexdigest)
-            # print(hexdigest[8:][:16])
-            json_payload = PROTOCOL_VERSION_BYTES + hexdigest[8:][:16].encode('latin1') + json_payload
-            # print('data_to_send')
-            # print(json_payload)
-            # print('crypted json_payload (%d) %r' % (len(json_payload), json_payload))
-            # print('json_payload  %r' % repr(json_payload))
-            # print('json_payload len %r' % len(json_payload))
-            # print(bin2hex(json_payload))
-            self.cipher = None  # expect to connect and then disconnect to set new
-
-        postfix_payload = hex2bin(bin2hex(json_payload) + payload_dict[self.dev_type]['suffix'])
-        # print('postfix_payload %r' % postfix_payload)
-        # print('postfix_payload %r' % len(postfix_payload))
-        # print('postfix_payload %x' % len(postfix_payload))
-        # print('postfix_payload %r' % hex(len(postfix_payload)))
-        assert len(postfix_payload) <= 0xff
-        postfix_payload_hex_len = '%x' % len(postfix_payload)  # TODO this assumes a single byte 0-255 (0x00-0xff)
-        buffer = hex2bin(payload_dict[self.dev_type]['prefix'] +
-                         payload_dict[self.dev_type][command]['hexByte'] +
-                         '000000' +
-                         postfix_payload_hex_len) + postfix_payload
-        # print('command', command)
-        # print('prefix')
-        # print(payload_dict[self.dev_type][command]['prefix'])
-        # print(repr(buffer))
-        # print(bin2hex(buffer, pretty=True))
-        # print(bin2hex(buffer, pretty=False))
-        # print('full buffer(%d) %r' % (len(buffer), buffer))
-        return buffer
+        return self.encoder.encode(command, data)
 
 
 class Device(XenonDevice):
-    def __init__(self, dev_id, address, local_key=None, dev_type=None):
-        super(Device, self).__init__(dev_id, address, local_key, dev_type)
+    def __init__(self, dev_id, address, local_key=None, dev_type=None, persistent=False):
+        super(Device, self).__init__(dev_id, address, local_key, dev_type, persistent=persistent)
 
     def status(self):
         log.debug('status() entry')
@@ -261,8 +747,16 @@ class Device(XenonDevice):
 
         data = self._send_receive(payload)
         log.debug('status received data=%r', data)
+        return self.parse_status(data)
+
+    def parse_status(self, message):
+        """
+        Decode a status reply into the device's json status.
 
-        result = data[20:-8]  # hard coded offsets
+        Args:
+            message(TuyaMessage): The reply received from the device.
+        """
+        result = message.payload
         log.debug('result=%r', result)
         # result = data[data.find('{'):data.rfind('}')+1]  # naive marker search, hope neither { nor } occur in header/footer
         # print('result %r' % result)
@@ -332,15 +826,15 @@ class Device(XenonDevice):
 
 
 class OutletDevice(Device):
-    def __init__(self, dev_id, address, local_key=None):
+    def __init__(self, dev_id, address, local_key=None, persistent=False):
         dev_type = 'device'
-        super(OutletDevice, self).__init__(dev_id, address, local_key, dev_type)
+        super(OutletDevice, self).__init__(dev_id, address, local_key, dev_type, persistent)
 
 
 class BulbDevice(Device):
-    def __init__(self, dev_id, address, local_key=None):
+    def __init__(self, dev_id, address, local_key=None, persistent=False):
         dev_type = 'device'
-        super(BulbDevice, self).__init__(dev_id, address, local_key, dev_type)
+        super(BulbDevice, self).__init__(dev_id, address, local_key, dev_type, persistent)
 
     def set_colour(self, r, g, b):
         """
@@ -351,43 +845,65 @@ class BulbDevice(Device):
             g(int): Value for the colour green as int from 0-255.
             b(int): Value for the colour blue as int from 0-255.
         """
-        if not 0 <= r <= 255:
-            raise ValueError("The value for red needs to be between 0 and 255.")
-        if not 0 <= g <= 255:
-            raise ValueError("The value for green needs to be between 0 and 255.")
-        if not 0 <= b <= 255:
-            raise ValueError("The value for blue needs to be between 0 and 255.")
-
-        rgb = [r, g, b]
-        hsv = colorsys.rgb_to_hsv(rgb[0] / 255, rgb[1] / 255, rgb[2] / 255)
-
-        hexvalue = ""
-        for value in rgb:
-            temp = str(hex(int(value))).replace("0x", "")
-            if len(temp) == 1:
-                temp = "0" + temp
-            hexvalue = hexvalue + temp
-
-        hsvarray = [int(hsv[0] * 360), int(hsv[1] * 255), int(hsv[2] * 255)]
-        hexvalue_hsv = ""
-        for value in hsvarray:
-            temp = str(hex(int(value))).replace("0x", "")
-            if len(temp) == 1:
-                temp = "0" + temp
-            hexvalue_hsv = hexvalue_hsv + temp
-        if len(hexvalue_hsv) == 7:
-            hexvalue = hexvalue + "0" + hexvalue_hsv
-        else:
-            hexvalue = hexvalue + "00" + hexvalue_hsv
-
-        payload = self.generate_payload(SET, {'5': hexvalue, '2': 'colour'})
+        payload = self.generate_payload(SET, self.colour_dps(r, g, b))
         data = self._send_receive(payload)
         return data
 
+    @staticmethod
+    def colour_dps(r, g, b):
+        """
+        The dps values that set the colour of an rgb bulb.
+
+        Args:
+            r(int): Value for the colour red as int from 0-255.
+            g(int): Value for the colour green as int from 0-255.
+            b(int): Value for the colour blue as int from 0-255.
+        """
+        return {'5': BulbDevice.colour_hexes([(r, g, b)])[0], '2': 'colour'}
+
+    @staticmethod
+    def colour_hexes(colours):
+        """
+        Convert a whole sequence of colours to the bulb's colour format at once: the rgb values
+        followed by the hsv values, as hex. Used for precomputing colour ramps.
+
+        Args:
+            colours(list): (r, g, b) tuples, each value an int from 0-255.
+
+        Returns:
+            list: The colour strings, in the same order.
+        """
+        rgb_to_hsv = colorsys.rgb_to_hsv
+        result = []
+        for r, g, b in colours:
+            if not 0 <= r <= 255:
+                raise ValueError("The value for red needs to be between 0 and 255.")
+            if not 0 <= g <= 255:
+                raise ValueError("The value for green needs to be between 0 and 255.")
+            if not 0 <= b <= 255:
+                raise ValueError("The value for blue needs to be between 0 and 255.")
+            h, s, v = rgb_to_hsv(r / 255.0, g / 255.0, b / 255.0)
+            # hue is 0-360 so it takes up to 3 hex digits, it's padded to 4
+            result.append('%02x%02x%02x%04x%02x%02x' % (int(r), int(g), int(b), int(h * 360), int(s * 255), int(v * 255)))
+        return result
+
     def set_white(self, brightness, colourtemp):
         """
         Set white coloured theme of an rgb bulb.
 
+        Args:
+            brightness(int): Value for the brightness (25-255).
+            colourtemp(int): Value for the colour temperature (0-255).
+        """
+        payload = self.generate_payload(SET, self.white_dps(brightness, colourtemp))
+        data = self._send_receive(payload)
+        return data
+
+    @staticmethod
+    def white_dps(brightness, colourtemp):
+        """
+        The dps values that set the white coloured theme of an rgb bulb.
+
         Args:
             brightness(int): Value for the brightness (25-255).
             colourtemp(int): Value for the colour temperature (0-255).
@@ -397,6 +913,4 @@ class BulbDevice(Device):
         if not 0 <= colourtemp <= 255:
             raise ValueError("The colour temperature needs to be between 0 and 255.")
 
-        payload = self.generate_payload(SET, {'2': 'white', '3': brightness, '4': colourtemp})
-        data = self._send_receive(payload)
-        return data
\ No newline at end of file
+        return {'2': 'white', '3': brightness, '4': colourtemp}
\ No newline at end of file
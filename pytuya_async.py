@@ -0,0 +1,236 @@
+# asyncio client for the devices supported by pytuya.
+#
+# Frames are built, encrypted and parsed by pytuya itself, only the network I/O is different: every
+# request is a coroutine on asyncio streams, so one event loop can talk to a whole fleet at once.
+#
+#     devices = [AsyncOutletDevice(dev_id, address, local_key) for dev_id, address, local_key in fleet]
+#     results = await gather_status(devices, concurrency=64)
+#
+# Requires Python 3.5 or newer.
+
+import asyncio
+import logging
+
+try:
+    from . import pytuya
+except ImportError:  # used outside of a package
+    import pytuya
+
+log = logging.getLogger(__name__)
+
+NETWORK_ERRORS = (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError)
+
+
+async def receive_message(reader, decoder, command):
+    """
+    Read until a reply for `command` is decoded. Frames for other commands, such as status updates
+    pushed by the device, are skipped.
+
+    Args:
+        reader(asyncio.StreamReader): The connection to the device.
+        decoder(pytuya.FrameDecoder): Decoder for this connection.
+        command(int): The command number of the request.
+    """
+    while True:
+        data = await reader.read(4096)
+        if not data:
+            raise ConnectionResetError('Connection closed by device')
+        for message in decoder.feed(data):
+            if message.cmd == command:
+                return message
+            log.debug('Skipping unexpected frame: %r', message)
+
+
+class AsyncDeviceMixin(object):
+    """
+    Replaces the blocking network methods of a pytuya device with coroutines. Must come before the
+    pytuya class in the bases, see AsyncOutletDevice.
+    """
+    def __init__(self, *args, **kwargs):
+        super(AsyncDeviceMixin, self).__init__(*args, **kwargs)
+        self._reader = None
+        self._writer = None
+        self._decoder = None
+        self._lock = None  # created on first use, so it belongs to the running loop
+
+    async def _send_receive(self, payload):
+        """
+        Send single buffer `payload` and receive the reply.
+
+        Args:
+            payload(bytes): Data to send.
+
+        Returns:
+            TuyaMessage: The decoded reply.
+        """
+        command = pytuya.frame_command(payload)
+        if self.persistent:
+            return await self._send_receive_persistent(payload, command)
+
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.address, self.port),
+                                                self.connection_timeout)
+        try:
+            writer.write(payload)
+            return await asyncio.wait_for(receive_message(reader, pytuya.FrameDecoder(), command),
+                                          self.connection_timeout)
+        finally:
+            writer.close()
+
+    async def _send_receive_persistent(self, payload, command):
+        """
+        Send over the connection kept open between requests. A reused connection may have been
+        dropped by the device while idle, so that is retried once on a new connection.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                reused = self._writer is not None
+                if not reused:
+                    self._reader, self._writer = await asyncio.wait_for(
+                        asyncio.open_connection(self.address, self.port), self.connection_timeout)
+                    self._decoder = pytuya.FrameDecoder()
+                try:
+                    self._writer.write(payload)
+                    return await asyncio.wait_for(receive_message(self._reader, self._decoder, command),
+                                                  self.connection_timeout)
+                except NETWORK_ERRORS:
+                    self._close()
+                    if not reused:
+                        raise
+                    log.debug('reused connection to %r failed, reconnecting', self)
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = self._decoder = None
+
+    async def close(self):
+        """
+        Close the connection kept open by persistent devices.
+        """
+        if self._lock is None:
+            self._close()
+            return
+        async with self._lock:
+            self._close()
+
+    async def status(self):
+        payload = self.generate_payload('status')
+        message = await self._send_receive(payload)
+        return self.parse_status(message)
+
+    async def set_status(self, on, switch=1):
+        """
+        Set status of the device to 'on' or 'off'.
+
+        Args:
+            on(bool):  True for 'on', False for 'off'.
+            switch(int): The switch to set
+        """
+        if isinstance(switch, int):
+            switch = str(switch)  # index and payload is a string
+        return await self.set_dps({switch: on})
+
+    async def set_dps(self, dps):
+        """
+        Set any number of dps values with a single SET frame.
+
+        Args:
+            dps(dict): dps index (string) -> value.
+        """
+        payload = self.generate_payload(pytuya.SET, dps)
+        return await self._send_receive(payload)
+
+    async def set_timer(self, num_secs):
+        """
+        Set a timer, see pytuya.Device.set_timer().
+
+        Args:
+            num_secs(int): Number of seconds
+        """
+        status = await self.status()
+        devices_numbers = sorted(status['dps'].keys())
+        return await self.set_dps({devices_numbers[-1]: num_secs})
+
+
+class AsyncOutletDevice(AsyncDeviceMixin, pytuya.OutletDevice):
+    pass
+
+
+class AsyncBulbDevice(AsyncDeviceMixin, pytuya.BulbDevice):
+    async def set_colour(self, r, g, b):
+        """
+        Set colour of an rgb bulb.
+
+        Args:
+            r(int): Value for the colour red as int from 0-255.
+            g(int): Value for the colour green as int from 0-255.
+            b(int): Value for the colour blue as int from 0-255.
+        """
+        return await self.set_dps(self.colour_dps(r, g, b))
+
+    async def set_white(self, brightness, colourtemp):
+        """
+        Set white coloured theme of an rgb bulb.
+
+        Args:
+            brightness(int): Value for the brightness (25-255).
+            colourtemp(int): Value for the colour temperature (0-255).
+        """
+        return await self.set_dps(self.white_dps(brightness, colourtemp))
+
+
+async def gather_bounded(calls, concurrency=32):
+    """
+    Run coroutine functions with at most `concurrency` running at once.
+
+    Args:
+        calls(list): Functions taking no arguments that return an awaitable.
+        concurrency(int): Maximum running at once.
+
+    Returns:
+        list: The results in the same order as `calls`. Calls that failed have their exception
+            in place of the result.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(call):
+        async with semaphore:
+            try:
+                return await call()
+            except Exception as e:
+                return e
+
+    return await asyncio.gather(*[run(call) for call in calls])
+
+
+async def gather_status(devices, concurrency=32):
+    """
+    Get the status of many devices concurrently.
+
+    Args:
+        devices(list): Async devices.
+        concurrency(int): Maximum requests in flight.
+
+    Returns:
+        list: The status of each device in the same order, or the exception if it failed.
+    """
+    return await gather_bounded([device.status for device in devices], concurrency)
+
+
+async def gather_set_status(devices, on, switch=1, concurrency=32):
+    """
+    Switch many devices on or off concurrently.
+
+    Args:
+        devices(list): Async devices.
+        on(bool):  True for 'on', False for 'off'.
+        switch(int): The switch to set.
+        concurrency(int): Maximum requests in flight.
+
+    Returns:
+        list: The reply from each device in the same order, or the exception if it failed.
+    """
+    return await gather_bounded([lambda device=device: device.set_status(on, switch) for device in devices],
+                                concurrency)
@@ -0,0 +1,203 @@
+"""
+This file was created by Yombo for use with Yombo Gateway automation
+software. Details can be found at https://yombo.net
+
+Tuya Registry
+=============
+
+Keeps a small record for every Tuya device, indexed by Tuya device_id, IP address and Yombo
+device_id, so looking up a device is a dictionary lookup however many there are.
+
+Each record owns one pytuya device for its whole life. The key is encoded, and the frame templates
+and signing suffix are built, once when the record is created, not every time the device is found
+or probed. Records are only replaced when the device's Tuya device_id or local_key changes.
+
+License
+=======
+
+See LICENSE.md for full license and attribution information.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+:license: Apache 2.0
+"""
+# Import python libraries
+from copy import copy
+
+from yombo.core.log import get_logger
+
+from . import pytuya
+
+logger = get_logger("modules.tuya.registry")
+
+
+class DeviceRecord(object):
+    """
+    A Tuya device: the Yombo device it belongs to, its credentials, and where it was last found.
+    """
+    __slots__ = ('tuya_id', 'local_key', 'device', 'tuya', 'address', 'version')
+
+    def __init__(self, device, tuya_id, local_key):
+        self.tuya_id = tuya_id
+        self.local_key = local_key
+        self.device = device
+        self.tuya = pytuya.OutletDevice(tuya_id, None, local_key)
+        self.address = None
+        self.version = None
+
+    def __repr__(self):
+        return "<DeviceRecord %s at %s>" % (self.tuya_id, self.address)
+
+    @property
+    def device_id(self):
+        return self.device.device_id
+
+    @property
+    def full_label(self):
+        return self.device.full_label
+
+    @property
+    def located(self):
+        return self.address is not None
+
+    def at(self, address, port=None):
+        """
+        A pytuya device for trying this device at another address. It shares this record's
+        encoder, so nothing is built again.
+
+        :param address:
+        :param port: Defaults to the current port.
+        :return: pytuya device.
+        """
+        tuya = copy(self.tuya)
+        tuya.address = address
+        if port is not None:
+            tuya.port = port
+        return tuya
+
+
+class DeviceRegistry(object):
+    """
+    The records of every Tuya device, with their indexes.
+    """
+    def __init__(self):
+        self.by_tuya_id = {}
+        self.by_device_id = {}
+        self.by_address = {}
+
+    def __len__(self):
+        return len(self.by_device_id)
+
+    def __iter__(self):
+        return iter(list(self.by_device_id.values()))
+
+    def get(self, device_id):
+        """
+        Get the record of a Yombo device, None if it doesn't have a Tuya device_id and local_key.
+        """
+        return self.by_device_id.get(device_id)
+
+    def find(self, tuya_id):
+        """
+        Get the record of a Tuya device_id, None if no Yombo device has it.
+        """
+        return self.by_tuya_id.get(tuya_id)
+
+    def at_address(self, address):
+        """
+        Get the record of the device last found at an address.
+        """
+        return self.by_address.get(address)
+
+    def located(self):
+        """
+        The number of devices that have been found on the network.
+        """
+        return len(self.by_address)
+
+    def update(self, device, tuya_id, local_key):
+        """
+        Add or refresh the record of a Yombo device. The existing record is kept if the Tuya
+        device_id and local_key haven't changed.
+
+        :param device: The Yombo device.
+        :param tuya_id: The Tuya device_id, None if the device doesn't have one.
+        :param local_key:
+        :return: Tuple of the record (None if the device has no Tuya device_id) and the record it
+            replaced (None if there wasn't one, or it was kept).
+        """
+        record = self.by_device_id.get(device.device_id)
+        if record is not None:
+            if tuya_id is not None and record.tuya_id == tuya_id and record.local_key == local_key:
+                record.device = device
+                return record, None
+            self.remove(device.device_id)
+        if tuya_id is None:
+            return None, record
+        new_record = DeviceRecord(device, tuya_id, local_key)
+        self.by_device_id[device.device_id] = new_record
+        self.by_tuya_id[tuya_id] = new_record
+        return new_record, record
+
+    def remove(self, device_id):
+        """
+        Remove a Yombo device's record.
+
+        :return: The removed record, None if there wasn't one.
+        """
+        record = self.by_device_id.pop(device_id, None)
+        if record is None:
+            return None
+        if self.by_tuya_id.get(record.tuya_id) is record:
+            del self.by_tuya_id[record.tuya_id]
+        if record.address is not None and self.by_address.get(record.address) is record:
+            del self.by_address[record.address]
+        return record
+
+    def sync(self, devices, credentials):
+        """
+        Bring the registry in line with the Yombo devices, only creating records for devices
+        that are new or whose credentials changed.
+
+        :param devices: Dictionary of Yombo device_id -> Yombo device.
+        :param credentials: Called as credentials(device), returns the Tuya device_id and local_key.
+        :return: List of records that were removed or replaced.
+        """
+        removed = []
+        for device_id in list(self.by_device_id):
+            if device_id not in devices:
+                removed.append(self.remove(device_id))
+        for device in devices.values():
+            record, replaced = self.update(device, *credentials(device))
+            if replaced is not None:
+                removed.append(replaced)
+        return removed
+
+    def set_address(self, record, address, port=None, version=None):
+        """
+        Record where a device was found.
+
+        :param record:
+        :param address:
+        :param port:
+        :param version: Protocol version, if known.
+        :return: Tuple of True if the address changed, and the record that was at the address
+            before (None if there wasn't one). That device moved, it's no longer located.
+        """
+        if version is not None:
+            record.version = version
+        if port is not None:
+            record.tuya.port = port
+        if record.address == address:
+            return False, None
+        if record.address is not None and self.by_address.get(record.address) is record:
+            del self.by_address[record.address]
+        other = self.by_address.get(address)
+        if other is not None and other is not record:
+            other.address = None  # the address was reused, the other device moved
+            other.tuya.address = None
+        else:
+            other = None
+        self.by_address[address] = record
+        record.address = address
+        record.tuya.address = address
+        return True, other
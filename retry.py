@@ -0,0 +1,245 @@
+"""
+This file was created by Yombo for use with Yombo Gateway automation
+software. Details can be found at https://yombo.net
+
+Tuya Retry
+==========
+
+Retries with exponential backoff, and circuit breakers for devices that are offline.
+
+A device that is busy gets a few attempts spaced further and further apart, with random jitter so
+retries from many callers don't line up. Once a device has failed several requests in a row its
+breaker opens: requests fail right away with DeviceOffline instead of waiting on timeouts, and the
+device is probed in the background, less often the longer it stays down. The first probe that
+gets an answer closes the breaker again.
+
+License
+=======
+
+See LICENSE.md for full license and attribution information.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+:license: Apache 2.0
+"""
+# Import python libraries
+from random import uniform
+from time import time
+
+# Import twisted libraries
+from twisted.internet import reactor
+from twisted.internet.defer import fail, inlineCallbacks, maybeDeferred
+
+from yombo.core.exceptions import YomboWarning
+from yombo.core.log import get_logger
+from yombo.utils import sleep
+
+from . import protocol
+
+logger = get_logger("modules.tuya.retry")
+
+RETRY_ATTEMPTS = 4  # Attempts per request, including the first.
+RETRY_BASE_DELAY = 0.25  # Seconds, the longest wait before the first retry. Doubles with every retry...
+RETRY_MAX_DELAY = 2  # ...up to this many seconds.
+RETRY_DEADLINE = 5  # Don't start another attempt this many seconds after the first one.
+FAILURE_THRESHOLD = 3  # Failed requests in a row that open a device's breaker.
+RESET_TIMEOUT = 30  # Seconds before an offline device is first probed. Doubles after every failed probe...
+MAX_RESET_TIMEOUT = 600  # ...up to this many seconds.
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class DeviceOffline(YomboWarning):
+    """
+    Raised instead of sending a request to a device whose circuit breaker is open.
+    """
+    pass
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with full jitter: the wait before retry n is random, between 0 and
+    min(max_delay, base_delay * 2 ** n).
+
+    :param attempts: Attempts per request, including the first.
+    :param base_delay: Longest wait before the first retry.
+    :param max_delay: Longest wait before any retry.
+    :param deadline: Seconds after the first attempt that no new attempt is started.
+    :param retry_on: Exception types worth retrying, anything else fails right away.
+    :param on_retry: Called as on_retry(attempt, error) before every retry.
+    """
+    def __init__(self, attempts=None, base_delay=None, max_delay=None, deadline=None, retry_on=None,
+                 on_retry=None):
+        self.attempts = RETRY_ATTEMPTS if attempts is None else attempts
+        self.base_delay = RETRY_BASE_DELAY if base_delay is None else base_delay
+        self.max_delay = RETRY_MAX_DELAY if max_delay is None else max_delay
+        self.deadline = RETRY_DEADLINE if deadline is None else deadline
+        self.retry_on = protocol.NETWORK_ERRORS if retry_on is None else retry_on
+        self.on_retry = on_retry
+
+    def delay(self, attempt):
+        """
+        Seconds to wait after the given failed attempt, counting from 0.
+        """
+        return uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    @inlineCallbacks
+    def run(self, function, *args, **kwargs):
+        """
+        Call function until it succeeds, fails with an error that isn't retried, or runs out of attempts.
+
+        :param function: Called with args and kwargs, may return a deferred.
+        :return: The function's result. The last error is raised if every attempt failed.
+        """
+        start_time = time()
+        attempt = 0
+        while True:
+            try:
+                result = yield maybeDeferred(function, *args, **kwargs)
+                return result
+            except self.retry_on as e:
+                delay = self.delay(attempt)
+                attempt += 1
+                if attempt >= self.attempts or time() + delay - start_time > self.deadline:
+                    raise
+                logger.debug("Attempt {attempt} failed ({e}), retrying in {delay:.2f}s",
+                             attempt=attempt, e=e, delay=delay)
+                if self.on_retry is not None:
+                    self.on_retry(attempt, e)
+                yield sleep(delay)
+
+
+class CircuitBreaker(object):
+    """
+    Tracks whether a single device is answering.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.state = CLOSED
+        self.failures = 0
+        self.reset_timeout = None
+        self.probe_call = None
+        self.opened_at = None
+
+
+class CircuitBreakers(object):
+    """
+    A circuit breaker per device.
+
+    :param probe: Called as probe(key) to check if an offline device is back, may return a deferred.
+        The device is back if it doesn't fail.
+    :param failure_threshold: Failed requests in a row that open a breaker.
+    :param reset_timeout: Seconds before the first probe of an offline device.
+    :param max_reset_timeout: Longest time between probes.
+    :param failure_types: Exception types that count as the device being unreachable.
+    """
+    def __init__(self, probe, failure_threshold=None, reset_timeout=None, max_reset_timeout=None,
+                 failure_types=None):
+        self.probe = probe
+        self.failure_threshold = FAILURE_THRESHOLD if failure_threshold is None else failure_threshold
+        self.reset_timeout = RESET_TIMEOUT if reset_timeout is None else reset_timeout
+        self.max_reset_timeout = MAX_RESET_TIMEOUT if max_reset_timeout is None else max_reset_timeout
+        self.failure_types = protocol.NETWORK_ERRORS if failure_types is None else failure_types
+        self.breakers = {}
+
+    def get(self, key):
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            breaker = self.breakers[key] = CircuitBreaker(key)
+        return breaker
+
+    def is_open(self, key):
+        breaker = self.breakers.get(key)
+        return breaker is not None and breaker.state != CLOSED
+
+    def call(self, key, function, *args, **kwargs):
+        """
+        Call function unless the device's breaker is open, and record how it went.
+
+        :param key: The device key, usually the Tuya device id.
+        :param function: Called with args and kwargs, may return a deferred.
+        :return: Deferred that fires with the function's result, or errbacks with DeviceOffline.
+        """
+        breaker = self.get(key)
+        if breaker.state != CLOSED:
+            return fail(DeviceOffline("Device is offline: %s" % key))
+        d = maybeDeferred(function, *args, **kwargs)
+        d.addCallbacks(self._call_succeeded, self._call_failed, callbackArgs=(key,), errbackArgs=(key,))
+        return d
+
+    def _call_succeeded(self, result, key):
+        self.success(key)
+        return result
+
+    def _call_failed(self, failure, key):
+        if failure.check(*self.failure_types):
+            self.failure(key)
+        return failure
+
+    def success(self, key):
+        """
+        The device answered, close its breaker.
+        """
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            return
+        if breaker.state != CLOSED:
+            logger.info("Tuya device {key} is back online.", key=key)
+        self._cancel_probe(breaker)
+        breaker.state = CLOSED
+        breaker.failures = 0
+        breaker.reset_timeout = None
+        breaker.opened_at = None
+
+    def failure(self, key):
+        """
+        A request to the device failed, open its breaker once enough have failed in a row.
+        """
+        breaker = self.get(key)
+        breaker.failures += 1
+        if breaker.state == CLOSED and breaker.failures >= self.failure_threshold:
+            logger.info("Tuya device {key} appears to be offline, will check it in the background.", key=key)
+            breaker.state = OPEN
+            breaker.opened_at = time()
+            breaker.reset_timeout = self.reset_timeout
+            self._schedule_probe(breaker)
+
+    def reset(self, key):
+        """
+        Forget everything about a device, such as when it's found at a new address.
+        """
+        breaker = self.breakers.pop(key, None)
+        if breaker is not None:
+            self._cancel_probe(breaker)
+
+    def stop(self):
+        for breaker in self.breakers.values():
+            self._cancel_probe(breaker)
+
+    def _schedule_probe(self, breaker):
+        self._cancel_probe(breaker)
+        breaker.probe_call = reactor.callLater(breaker.reset_timeout, self._probe, breaker)
+
+    def _cancel_probe(self, breaker):
+        if breaker.probe_call is not None and breaker.probe_call.active():
+            breaker.probe_call.cancel()
+        breaker.probe_call = None
+
+    def _probe(self, breaker):
+        breaker.probe_call = None
+        breaker.state = HALF_OPEN
+        maybeDeferred(self.probe, breaker.key).addCallbacks(self._probe_succeeded, self._probe_failed,
+                                                             callbackArgs=(breaker,), errbackArgs=(breaker,))
+
+    def _probe_succeeded(self, result, breaker):
+        if self.breakers.get(breaker.key) is breaker and breaker.state == HALF_OPEN:
+            self.success(breaker.key)
+
+    def _probe_failed(self, failure, breaker):
+        if self.breakers.get(breaker.key) is not breaker or breaker.state != HALF_OPEN:
+            return
+        logger.debug("Tuya device {key} is still offline: {error}", key=breaker.key, error=failure.getErrorMessage())
+        breaker.state = OPEN
+        breaker.reset_timeout = min(self.max_reset_timeout, breaker.reset_timeout * 2)
+        self._schedule_probe(breaker)
@@ -0,0 +1,331 @@
+"""
+This file was created by Yombo for use with Yombo Gateway automation
+software. Details can be found at https://yombo.net
+
+Tuya Scanner
+============
+
+Finds hosts with the Tuya port open. Connections are non-blocking and the number of probes in flight
+adapts to the network: it grows while connects are answered quickly, and is halved when the round
+trip time climbs or local errors (such as running out of sockets) show up.
+
+Hosts from the kernel's neighbor (ARP) table are probed first, since those are known to be alive.
+The remaining addresses are generated lazily from the networks being scanned, so a large subnet
+doesn't queue up a deferred per address.
+
+SweepCursor lets a sweep be done a slice at a time, and ScanPlanner debounces scan requests so a
+burst of device changes results in a single scan.
+
+License
+=======
+
+See LICENSE.md for full license and attribution information.
+
+.. moduleauthor:: Mitch Schwenk <mitch-gw@yombo.net>
+:license: Apache 2.0
+"""
+# Import python libraries
+from itertools import chain
+import os
+from time import time
+from netaddr import IPAddress, IPNetwork
+
+# Import twisted libraries
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredList, maybeDeferred
+from twisted.python.failure import Failure
+
+from yombo.core.log import get_logger
+
+from . import protocol
+
+logger = get_logger("modules.tuya.scanner")
+
+ARP_TABLE = '/proc/net/arp'
+SCAN_DEBOUNCE = 5  # Seconds without new scan requests before scanning.
+SCAN_MAX_DELAY = 30  # Longest a scan request waits while new requests keep arriving.
+
+
+def read_neighbor_table(networks=None):
+    """
+    Get the IP addresses from the kernel's neighbor (ARP) table. Only works on Linux, returns an empty
+    list elsewhere.
+
+    :param networks: Only return addresses in these networks, in CIDR notation or IPNetwork.
+    :return: List of IP addresses as strings.
+    """
+    if not os.path.exists(ARP_TABLE):
+        return []
+    hosts = []
+    try:
+        with open(ARP_TABLE) as arp_file:
+            next(arp_file)  # header
+            for line in arp_file:
+                fields = line.split()
+                if len(fields) >= 4 and fields[2] != '0x0':  # 0x0 is an incomplete entry
+                    hosts.append(fields[0])
+    except (IOError, StopIteration):
+        pass
+    if networks is not None:
+        networks = [IPNetwork(network) for network in networks]
+        hosts = [host for host in hosts if any(IPAddress(host) in network for network in networks)]
+    return hosts
+
+
+class NetworkScanner(object):
+    """
+    Scans one or more networks for an open port, calling found_callback(host, port) for every host
+    that accepts the connection. If found_callback returns a deferred, the scan isn't considered
+    done until it fires.
+
+    :param found_callback: Called for every open host.
+    :param port: Port to probe.
+    :param timeout: Seconds to wait for each connect.
+    :param initial_concurrency: Probes in flight when the scan starts.
+    :param min_concurrency: Never go below this many probes in flight.
+    :param max_concurrency: Never go above this many probes in flight.
+    """
+    ERROR_RATE_LIMIT = 0.05  # Back off when more than 5% of probes fail locally.
+    RTT_LIMIT = 4  # Back off when the average connect time is this many times the best seen...
+    RTT_FLOOR = 0.05  # ...and above this many seconds, sub-millisecond LAN times are too noisy to compare.
+
+    def __init__(self, found_callback, port=None, timeout=.3, initial_concurrency=32, min_concurrency=4,
+                 max_concurrency=256):
+        if port is None:
+            port = protocol.DEFAULT_PORT
+        self.found_callback = found_callback
+        self.port = port
+        self.timeout = timeout
+        self.concurrency = initial_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+
+        self.in_flight = 0
+        self.hosts = None
+        self.found_deferreds = []
+        self.deferred = None
+        self.stopping = False
+        self.finishing = False
+
+        # Statistics for adapting concurrency and for reporting.
+        self.probed = 0
+        self.open_hosts = 0
+        self.errors = 0
+        self.rtt_average = None
+        self.rtt_best = None
+        self.window_completed = 0
+        self.window_errors = 0
+        self.started_at = None
+        self.duration = None
+
+    def scan(self, networks, skip=None, hosts=None):
+        """
+        Start scanning.
+
+        :param networks: List of networks in CIDR notation.
+        :param skip: IP addresses (strings) to not probe.
+        :param hosts: Only probe these IP addresses (strings), instead of the neighbor table and
+            every host in the networks.
+        :return: Deferred that fires with the number of open hosts found, once the scan is complete.
+        """
+        skip = set() if skip is None else set(skip)
+        self.started_at = time()
+        self.deferred = Deferred()
+        if hosts is None:
+            self.hosts = self._hosts([IPNetwork(network) for network in networks], skip)
+        else:
+            self.hosts = (host for host in hosts if host not in skip)
+        self._fill()
+        return self.deferred
+
+    def stop(self):
+        """
+        Don't start any more probes, the scan completes once the probes in flight finish.
+        """
+        self.stopping = True
+
+    def _hosts(self, networks, skip):
+        """
+        Generates the hosts to probe: neighbor table entries first, then every host in the networks.
+        """
+        seen = set(skip)  # Only the skipped and neighbor hosts, so memory doesn't grow with the subnet size.
+        for host in read_neighbor_table(networks):
+            if host not in seen:
+                seen.add(host)
+                yield host
+
+        for address in chain(*[network.iter_hosts() for network in networks]):
+            host = str(address)
+            if host not in seen:
+                yield host
+
+    def _fill(self):
+        while self.stopping is False and self.in_flight < self.concurrency:
+            host = next(self.hosts, None)
+            if host is None:
+                break
+            self.in_flight += 1
+            self.probed += 1
+            d = protocol.probe_port(host, self.port, self.timeout)
+            d.addBoth(self._probe_done, host, time())
+        if self.in_flight == 0 and self.finishing is False:
+            self.finishing = True
+            self._finished()
+
+    def _probe_done(self, result, host, started):
+        self.in_flight -= 1
+        self.window_completed += 1
+        elapsed = time() - started
+        if result is True or result is False:
+            if elapsed < self.timeout:  # timeouts say nothing about the network's speed
+                self._add_rtt(elapsed)
+            if result is True:
+                self.open_hosts += 1
+                self.found_deferreds.append(maybeDeferred(self.found_callback, host, self.port))
+        else:
+            self.errors += 1
+            self.window_errors += 1
+            logger.debug("Local error probing {host}: {error}", host=host, error=result.getErrorMessage())
+
+        if self.window_completed >= self.concurrency:
+            self._adapt()
+        self._fill()
+
+    def _add_rtt(self, rtt):
+        if self.rtt_average is None:
+            self.rtt_average = rtt
+        else:
+            self.rtt_average = self.rtt_average * 0.8 + rtt * 0.2
+        if self.rtt_best is None or rtt < self.rtt_best:
+            self.rtt_best = rtt
+
+    def _adapt(self):
+        """
+        Additive increase, multiplicative decrease, evaluated after every window of completed probes.
+        """
+        error_rate = self.window_errors / self.window_completed
+        slow = self.rtt_best is not None and \
+            self.rtt_average > max(self.rtt_best * self.RTT_LIMIT, self.RTT_FLOOR)
+        if error_rate > self.ERROR_RATE_LIMIT or slow:
+            self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+        else:
+            self.concurrency = min(self.max_concurrency, self.concurrency + max(1, self.concurrency // 4))
+        self.window_completed = 0
+        self.window_errors = 0
+
+    def _finished(self):
+        def done(results):
+            self.duration = time() - self.started_at
+            logger.debug("Scan finished in {duration:.2f}s, probed {probed} hosts, {open} open, {errors} errors.",
+                         duration=self.duration, probed=self.probed, open=self.open_hosts, errors=self.errors)
+            self.deferred.callback(self.open_hosts)
+
+        DeferredList(self.found_deferreds, consumeErrors=True).addCallback(done)
+
+
+class SweepCursor(object):
+    """
+    Hands out the hosts of one or more networks a slice at a time, continuing where the previous
+    slice ended and starting over after the last host. If the networks change, the sweep starts
+    from the beginning.
+    """
+    def __init__(self):
+        self.networks = []
+        self.position = 0
+
+    def next_hosts(self, networks, count):
+        """
+        Get the next slice of hosts.
+
+        :param networks: List of networks in CIDR notation.
+        :param count: Hosts to return, fewer if the networks are smaller.
+        :return: List of IP addresses as strings.
+        """
+        networks = [IPNetwork(network) for network in networks]
+        if networks != self.networks:
+            self.networks = networks
+            self.position = 0
+        ranges = [(network.version, self._host_range(network)) for network in networks]
+        total = sum(len(addresses) for version, addresses in ranges)
+        count = min(count, total)
+
+        hosts = []
+        for offset in range(count):
+            index = (self.position + offset) % total
+            for version, addresses in ranges:
+                if index < len(addresses):
+                    hosts.append(str(IPAddress(addresses[index], version)))
+                    break
+                index -= len(addresses)
+        if total > 0:
+            self.position = (self.position + count) % total
+        return hosts
+
+    @staticmethod
+    def _host_range(network):
+        """
+        The usable host addresses of a network as integers, without the network and broadcast addresses.
+        """
+        if network.size <= 2:
+            return range(network.first, network.last + 1)
+        return range(network.first + 1, network.last)
+
+
+class ScanPlanner(object):
+    """
+    Debounces scan requests: the scan starts once no new request has arrived for debounce seconds,
+    or max_delay seconds after the first request, whichever comes first. Requests made while a
+    scan is running start another scan once it's done, so no request is lost.
+
+    :param run: Called as run(fast=...) to scan, may return a deferred.
+    :param debounce: Seconds without new requests before scanning.
+    :param max_delay: Longest a request waits.
+    """
+    def __init__(self, run, debounce=None, max_delay=None):
+        self.run = run
+        self.debounce = SCAN_DEBOUNCE if debounce is None else debounce
+        self.max_delay = SCAN_MAX_DELAY if max_delay is None else max_delay
+        self.call = None
+        self.first_request = None
+        self.fast = False
+        self.running = False
+        self.requested_while_running = False
+
+    def request(self, fast=False):
+        """
+        Ask for a scan.
+
+        :param fast: Sweep the whole network at full speed, if a sweep is needed.
+        :return:
+        """
+        self.fast = self.fast or fast
+        if self.running:
+            self.requested_while_running = True
+            return
+        now = time()
+        if self.call is not None and self.call.active():
+            delay = min(self.debounce, self.first_request + self.max_delay - now)
+            self.call.reset(max(0, delay))
+            return
+        self.first_request = now
+        self.call = reactor.callLater(self.debounce, self._start)
+
+    def cancel(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+    def _start(self):
+        self.call = None
+        fast = self.fast
+        self.fast = False
+        self.running = True
+        maybeDeferred(self.run, fast=fast).addBoth(self._finished)
+
+    def _finished(self, result):
+        self.running = False
+        if self.requested_while_running:
+            self.requested_while_running = False
+            self.request()
+        if isinstance(result, Failure):
+            logger.warn("Tuya scan failed: {error}", error=result.getErrorMessage())
@@ -0,0 +1,165 @@
+"""
+Tests for the pytuya frame codec: FrameEncoder, FrameDecoder and status parsing.
+
+Usage::
+
+    python -m unittest discover -s tests
+"""
+from hashlib import md5
+import json
+import os
+import struct
+import sys
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytuya  # noqa: E402
+
+DEV_ID = '0123456789abcdef0123'
+LOCAL_KEY = '0123456789abcdef'
+STATUS_JSON = b'{"devId":"0123456789abcdef0123","dps":{"1":true,"2":0},"t":1700000000,"s":123}'
+
+
+def build_frame(cmd, payload, retcode=None, seqno=1, crc=None):
+    """
+    Build a frame the way a device sends it, optionally with a return code or a wrong crc.
+    """
+    body = payload if retcode is None else struct.pack('>I', retcode) + payload
+    header = struct.pack(pytuya.HEADER_FORMAT, pytuya.PREFIX, seqno, cmd, len(body) + pytuya.FOOTER_SIZE)
+    if crc is None:
+        crc = zlib.crc32(header + body) & 0xffffffff
+    return header + body + struct.pack(pytuya.FOOTER_FORMAT, crc, pytuya.SUFFIX)
+
+
+class FrameEncoderTest(unittest.TestCase):
+    def setUp(self):
+        self.device = pytuya.OutletDevice(DEV_ID, '127.0.0.1', LOCAL_KEY)
+
+    def decode_one(self, frame):
+        messages = pytuya.FrameDecoder().feed(frame)
+        self.assertEqual(len(messages), 1)
+        return messages[0]
+
+    def decrypt_set(self, payload):
+        self.assertTrue(payload.startswith(pytuya.PROTOCOL_VERSION_BYTES))
+        encrypted = payload[len(pytuya.PROTOCOL_VERSION_BYTES) + 16:]
+        return pytuya.AESCipher(LOCAL_KEY.encode('latin1')).decrypt(encrypted)
+
+    def test_status_round_trip(self):
+        frame = self.device.generate_payload('status')
+        message = self.decode_one(frame)
+        self.assertEqual(message.cmd, 0x0a)
+        self.assertIsNone(message.retcode)
+        self.assertEqual(json.loads(message.payload.decode()), {'gwId': DEV_ID, 'devId': DEV_ID})
+        self.assertEqual(pytuya.frame_command(frame), 0x0a)
+
+    def test_sequence_numbers_increase(self):
+        first = self.decode_one(self.device.generate_payload('status'))
+        second = self.decode_one(self.device.generate_payload('status'))
+        self.assertEqual(second.seqno, first.seqno + 1)
+
+    def test_set_round_trip(self):
+        message = self.decode_one(self.device.generate_payload(pytuya.SET, {'1': True, '2': 'a b c'}))
+        self.assertEqual(message.cmd, 0x07)
+        self.assertIsNone(message.retcode)
+        decrypted = self.decrypt_set(message.payload)
+        self.assertIn('"dps":{"1":true,"2":"a b c"}', decrypted)  # compact, the devices reject json with spaces
+        self.assertEqual(json.loads(decrypted)['dps'], {'1': True, '2': 'a b c'})
+
+    def test_set_signature(self):
+        message = self.decode_one(self.device.generate_payload(pytuya.SET, {'1': False}))
+        encrypted = message.payload[len(pytuya.PROTOCOL_VERSION_BYTES) + 16:]
+        signed = b'data=' + encrypted + b'||lpv=' + pytuya.PROTOCOL_VERSION_BYTES + b'||' + LOCAL_KEY.encode('latin1')
+        expected = md5(signed).hexdigest()[8:24].encode('latin1')
+        self.assertEqual(message.payload[len(pytuya.PROTOCOL_VERSION_BYTES):len(pytuya.PROTOCOL_VERSION_BYTES) + 16],
+                         expected)
+
+    def test_large_payload(self):
+        dps = {str(index): 'value %d' % index for index in range(1, 40)}
+        frame = self.device.generate_payload(pytuya.SET, dps)
+        self.assertGreater(len(frame), 255 + pytuya.HEADER_SIZE + pytuya.FOOTER_SIZE)
+        length = struct.unpack_from(pytuya.HEADER_FORMAT, frame)[3]
+        self.assertEqual(length, len(frame) - pytuya.HEADER_SIZE)
+        message = self.decode_one(frame)
+        self.assertEqual(json.loads(self.decrypt_set(message.payload))['dps'], dps)
+
+
+class FrameDecoderTest(unittest.TestCase):
+    def test_split_frame(self):
+        frame = build_frame(0x0a, STATUS_JSON)
+        decoder = pytuya.FrameDecoder()
+        for index in range(len(frame) - 1):
+            self.assertEqual(decoder.feed(frame[index:index + 1]), [])
+        messages = decoder.feed(frame[-1:])
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].payload, STATUS_JSON)
+        self.assertEqual(len(decoder.buffer), 0)
+
+    def test_concatenated_frames(self):
+        first = build_frame(0x08, STATUS_JSON, seqno=1)
+        second = build_frame(0x0a, STATUS_JSON, seqno=2)
+        third = build_frame(0x09, b'', retcode=0, seqno=3)
+        decoder = pytuya.FrameDecoder()
+        messages = decoder.feed(first + second + third[:10])
+        self.assertEqual([message.seqno for message in messages], [1, 2])
+        messages = decoder.feed(third[10:])
+        self.assertEqual([(message.seqno, message.cmd) for message in messages], [(3, 0x09)])
+
+    def test_bad_crc(self):
+        bad = build_frame(0x0a, STATUS_JSON, seqno=1, crc=0x12345678)
+        good = build_frame(0x0a, STATUS_JSON, seqno=2)
+        messages = pytuya.FrameDecoder().feed(bad + good)
+        self.assertEqual([message.seqno for message in messages], [2])
+        messages = pytuya.FrameDecoder(validate_crc=False).feed(bad + good)
+        self.assertEqual([message.seqno for message in messages], [1, 2])
+
+    def test_garbage_before_frame(self):
+        frame = build_frame(0x0a, STATUS_JSON)
+        decoder = pytuya.FrameDecoder()
+        self.assertEqual(decoder.feed(b'\x01\x02garbage\x00\x00'), [])
+        messages = decoder.feed(frame)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].payload, STATUS_JSON)
+
+    def test_reply_with_retcode(self):
+        message = pytuya.FrameDecoder().feed(build_frame(0x0a, STATUS_JSON, retcode=0))[0]
+        self.assertEqual(message.retcode, 0)
+        self.assertEqual(message.payload, STATUS_JSON)
+
+    def test_reply_with_error_retcode_and_no_payload(self):
+        message = pytuya.FrameDecoder().feed(build_frame(0x07, b'', retcode=1))[0]
+        self.assertEqual(message.retcode, 1)
+        self.assertEqual(message.payload, b'')
+
+    def test_reply_without_retcode(self):
+        message = pytuya.FrameDecoder().feed(build_frame(0x0a, STATUS_JSON))[0]
+        self.assertIsNone(message.retcode)
+        self.assertEqual(message.payload, STATUS_JSON)
+
+    def test_encrypted_reply_without_retcode(self):
+        encrypted = pytuya.PROTOCOL_VERSION_BYTES + b'0' * 16 + \
+            pytuya.AESCipher(LOCAL_KEY.encode('latin1')).encrypt(STATUS_JSON)
+        message = pytuya.FrameDecoder().feed(build_frame(0x08, encrypted))[0]
+        self.assertIsNone(message.retcode)
+        self.assertEqual(message.payload, encrypted)
+
+
+class ParseStatusTest(unittest.TestCase):
+    def setUp(self):
+        self.device = pytuya.OutletDevice(DEV_ID, '127.0.0.1', LOCAL_KEY)
+
+    def test_plain(self):
+        message = pytuya.FrameDecoder().feed(build_frame(0x0a, STATUS_JSON, retcode=0))[0]
+        self.assertEqual(self.device.parse_status(message)['dps'], {'1': True, '2': 0})
+
+    def test_encrypted(self):
+        encrypted = pytuya.PROTOCOL_VERSION_BYTES + b'0' * 16 + \
+            pytuya.AESCipher(LOCAL_KEY.encode('latin1')).encrypt(STATUS_JSON)
+        message = pytuya.FrameDecoder().feed(build_frame(0x08, encrypted))[0]
+        self.assertEqual(self.device.parse_status(message)['dps'], {'1': True, '2': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
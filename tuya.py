@@ -41,30 +41,44 @@ try:  # Prefer simplejson if installed, otherwise json will work swell.
     import simplejson as json
 except ImportError:
     import json
+from functools import partial
+import os
 from time import time
-from time import sleep as time_sleep
-from socket import AF_INET, SOCK_STREAM, socket, SHUT_RDWR
-from netaddr import IPNetwork
 
 # Import twisted libraries
-from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, DeferredSemaphore, DeferredList
-from twisted.internet import threads
+from twisted.internet.defer import inlineCallbacks, DeferredList, DeferredSemaphore
+from twisted.internet.error import ConnectionDone, ConnectionLost, ConnectionRefusedError, TimeoutError
 from twisted.internet.task import LoopingCall
 
 # Import 3rd party libraries
-from yombo.ext.expiringdict import ExpiringDict
-
 from yombo.core.exceptions import YomboWarning
 from yombo.core.log import get_logger
 from yombo.core.module import YomboModule
 from yombo.utils.networking import get_local_network_info
-from yombo.utils import sleep
 
-from . import pytuya
+from . import protocol
+from .cache import StatusCache
+from .changes import ChangeDetector, StatusPublisher
+from .commands import CommandExpired, CommandQueue, WriteCoalescer, PRIORITY_POLL, PRIORITY_USER
+from .discovery import TuyaDiscovery
+from .effects import DEFAULT_FPS, BulbStream, EffectScheduler, colour_frames, colour_ramp
+from .metrics import TuyaMetrics
+from .poller import PollScheduler
+from .registry import DeviceRegistry
+from .retry import CircuitBreakers, DeviceOffline, RetryPolicy
+from .scanner import NetworkScanner, ScanPlanner, SweepCursor, read_neighbor_table
 
 logger = get_logger("modules.tuya")
 
+KNOWN_LOCATION_TIMEOUT = 2  # Seconds to wait for a device at its last known address during startup.
+LOCATION_MAX_AGE = 300  # Devices confirmed at their last known address this recently don't need to be scanned for.
+SWEEP_INTERVAL = 300  # Seconds between periodic scans.
+SWEEP_CHUNK = 256  # Hosts swept by each periodic scan, the next one continues where it stopped.
+PROTOCOL_VERSION = '3.1'
+BULK_CONCURRENCY = 32  # Devices written at the same time by send_bulk_command().
+METRICS_INTERVAL = 60  # Seconds between sending gauges to the statistics library and writing the Prometheus file.
+TOGGLE_MAX_AGE = 30  # Seconds a cached switch state is trusted by toggle(), unless the device is pushing updates.
+
 
 class Tuya(YomboModule):
     """
@@ -79,26 +93,77 @@ class Tuya(YomboModule):
         """
         self._module_starting()
         self.yombo_devices = self._module_devices_cached
-        self.tuya_devices = {}  # Used to map tuya devices to yombo devices, and their IP address
+        self.registry = DeviceRegistry()  # Tuya devices by Tuya device_id, address and Yombo device_id
         self.scan_running = False
-        self.current_scan_results = {}
-        self.status_cache = ExpiringDict(max_len=1000, max_age_seconds=5)
-        self.scan_for_tuya_devices_loop = LoopingCall(self.scan_for_tuya_devices)
+        self.scanner = None
+        self.current_scan_results = set()  # Yombo device_ids located by the current scan
+        self.device_locations = {}  # Tuya device_id -> last known address, port and version. Persisted.
+        self.status_cache = StatusCache(self.fetch_dps)  # Tuya device_id -> dps values
+        self.changes = ChangeDetector()  # Tuya device_id -> dps values last published to Yombo
+        self.status_publisher = StatusPublisher(self.set_device_status)
+        self.scan_planner = ScanPlanner(self.scan_for_tuya_devices)
+        self.sweep_cursor = SweepCursor()
+        self.scan_for_tuya_devices_loop = LoopingCall(self.scan_planner.request)
+        self.discovery = TuyaDiscovery(self.device_discovered)
+        self.write_coalescer = WriteCoalescer(self.send_dps)
+        self.command_queue = CommandQueue()
+        self.listeners = {}  # Tuya device_id -> protocol.TuyaListenerFactory, receives pushed status updates
+        self.poller = PollScheduler(self.poll_device)
+        self.metrics = TuyaMetrics(self._Statistics)
+        self.retry_policy = RetryPolicy(on_retry=lambda attempt, error: self.metrics.increment('tuya_retries_total'))
+        # Identifying a host only retries a busy device, such as one still closing the scanner's
+        # connection. A host that doesn't answer at all isn't asked again.
+        self.identify_retry_policy = RetryPolicy(retry_on=(ConnectionRefusedError, ConnectionDone, ConnectionLost))
+        self.breakers = CircuitBreakers(self.probe_device)  # Tuya device_id -> is the device answering
+        self.metrics_loop = LoopingCall(self.report_metrics)
+        self.effects = EffectScheduler()
+        self.add_metric_gauges()
 
     @inlineCallbacks
     def _load_(self, **kwargs):
-        yield self.scan_for_tuya_devices(fast=True, startup=True)
-        self.scan_for_tuya_devices_loop.start(1800, False)
-        reactor.callLater(30, self.scan_for_tuya_devices)
+        """
+        Checks the devices at their last known addresses and marks the module as started once they
+        have answered. A background scan then finds any devices that moved.
+
+        :param kwargs:
+        :return:
+        """
+        self.device_locations = yield self._SQLDict.get(self, "device_locations")
+        self.build_device_index()
+        self.discovery.start()
+        yield self.check_known_locations()
+        self._module_started()
+        self.scan_for_tuya_devices_loop.start(SWEEP_INTERVAL, False)
+        self.poller.start()
+        self.metrics_loop.start(METRICS_INTERVAL, False)
+        self.scan_planner.request(fast=True)
+
+    def _unload_(self, **kwargs):
+        self.discovery.stop()
+        self.scan_planner.cancel()
+        if self.scan_for_tuya_devices_loop.running:
+            self.scan_for_tuya_devices_loop.stop()
+        self.poller.stop()
+        self.effects.stop()
+        self.breakers.stop()
+        if self.metrics_loop.running:
+            self.metrics_loop.stop()
+        self.write_coalescer.flush_all()
+        self.status_publisher.flush()
+        for listener in self.listeners.values():
+            listener.stop()
+        self.listeners = {}
 
     def _device_changed_(self, **kwargs):
         """
-        We listen for device updates, so we can re-scan when things change.
+        We listen for device updates, so we can re-scan when things change. Scan requests are
+        debounced, editing many devices results in one scan.
 
         :param kwargs:
         :return:
         """
-        reactor.callLater(5, self.scan_for_tuya_devices)
+        self.build_device_index(kwargs.get('device'))
+        self.scan_planner.request()
 
     def _device_variables_updated_(self, **kwargs):
         """
@@ -107,237 +172,853 @@ class Tuya(YomboModule):
         :param kwargs:
         :return:
         """
-        reactor.callLater(5, self.scan_for_tuya_devices)
+        self.build_device_index(kwargs.get('device'))
+        self.scan_planner.request()
 
-    @inlineCallbacks
-    def scan_for_tuya_devices(self, fast=None, startup=None):
+    def get_tuya_credentials(self, device):
+        """
+        Get the Tuya device_id and local_key from the device variables.
+
+        :param device:
+        :return: Tuple of device_id and local_key, both are None if either is missing.
+        """
+        device_variables = device.device_variables_cached
+        var_device_id = device_variables['device_id']['values'][0]
+        if var_device_id == '':
+            logger.warn("Device is missing Tuya device_id: {label}", label=device.full_label)
+            return None, None
+        var_local_key = device_variables['local_key']['values'][0]
+        if var_local_key == '':
+            logger.warn("Device is missing Tuya local_key: {label}", label=device.full_label)
+            return None, None
+        return var_device_id, var_local_key
+
+    def build_device_index(self, device=None):
         """
-        Scours the local intranet for Tuya devices.
+        Update the device registry, this lets a device be identified from the devId in a status
+        reply or broadcast. Records are only created for devices that are new or whose Tuya
+        device_id or local_key changed.
 
+        :param device: The Yombo device that changed, if known. Otherwise all devices are checked.
         :return:
         """
-        if self.scan_running is True:
-            return
-        self.scan_running = True
-        logger.debug("Tuya device scanning started.")
-        self.current_scan_results = []
-        if fast is True:
-            number_of_workers = 30
+        if device is not None and device.device_id in self._module_devices_cached:
+            record, replaced = self.registry.update(device, *self.get_tuya_credentials(device))
+            removed = [] if replaced is None else [replaced]
         else:
-            number_of_workers = 1
-        address_info = get_local_network_info()
-        iprange = IPNetwork(address_info['ipv4']['cidr'])
-
-        search_semaphore = DeferredSemaphore(number_of_workers)
-        all_searchers = []
+            removed = self.registry.sync(self._module_devices_cached, self.get_tuya_credentials)
+        for record in removed:
+            self.forget_device(record)
 
-        for host in iprange:
-            d = search_semaphore.run(self.search_ip_address, str(host), 6668, fast)
-            all_searchers.append(d)
-        yield DeferredList(all_searchers)
+    def forget_device(self, record):
+        """
+        Stop everything running for a device that was removed from the registry.
 
-        self.scan_running = False
-        if startup is True:
-            self._module_started()
-        logger.debug("Tuya device scanning finished")
+        :param record:
+        :return:
+        """
+        listener = self.listeners.pop(record.tuya_id, None)
+        if listener is not None:
+            listener.stop()
+        self.poller.remove(record.tuya_id)
+        self.breakers.reset(record.tuya_id)
+        self.changes.forget(record.tuya_id)
+        self.status_cache.invalidate(record.tuya_id)
 
-    @inlineCallbacks
-    def search_ip_address(self, host, port, fast=None):
+    def attach_tuya(self, record, host, port=None, version=None):
         """
-        This method was split up to help enable semaphores.
+        Store where a device was found, and remember it for the next startup.
 
+        :param record:
         :param host:
         :param port:
+        :param version: Protocol version, if known.
         :return:
         """
-        yield threads.deferToThread(self.do_search_ip_address, host, port, fast)
+        moved, displaced = self.registry.set_address(record, host, port, version)
+        if displaced is not None:
+            logger.info("{label} is no longer at {address}.", label=displaced.full_label, address=host)
+            listener = self.listeners.pop(displaced.tuya_id, None)
+            if listener is not None:
+                listener.stop()
+            self.poller.remove(displaced.tuya_id)
+        if moved or record.tuya_id not in self.listeners:
+            self.breakers.reset(record.tuya_id)
+            self.start_listener(record)
+        self.remember_location(record.tuya_id, host, record.tuya.port, record.version)
+        self.poller.add(record.tuya_id)
 
-    def do_search_ip_address(self, host, port, fast=None):
+    def start_listener(self, record):
+        """
+        Open a long lived connection to a device, replacing any previous one, so status changes
+        made at the device (such as pressing the button) are pushed to us as they happen.
+
+        :param record:
+        :return:
         """
-        Do the actual search. This is a blocking function.
+        listener = self.listeners.pop(record.tuya_id, None)
+        if listener is not None:
+            listener.stop()
+        self.listeners[record.tuya_id] = protocol.listen(record.tuya, partial(self.status_pushed, record.tuya_id))
 
+    def status_pushed(self, tuya_id, message):
+        """
+        Called by a device's listener when the device pushes a status update.
+
+        :param tuya_id:
+        :param message: The pushed pytuya.TuyaMessage.
+        :return:
+        """
+        record = self.registry.find(tuya_id)
+        if record is None or record.located is False:
+            return
+        try:
+            data = record.tuya.parse_status(message)
+        except Exception as e:
+            logger.debug("Unable to decode status pushed by {label}: {e}", label=record.full_label, e=e)
+            return
+        if not isinstance(data, dict) or 'dps' not in data:
+            return
+        logger.debug("Status pushed by {label}: {dps}", label=record.full_label, dps=data['dps'])
+        self.metrics.increment('tuya_pushes_total', device=tuya_id)
+        self.breakers.success(tuya_id)
+        self.status_cache.update(tuya_id, data['dps'])
+        if self.status_changed(record, data['dps']):
+            self.poller.activity(tuya_id)
+
+    def remember_location(self, tuya_id, host, port, version=None):
+        """
+        Update the persisted location of a device. Used on the next startup to find devices
+        without scanning the network.
+
+        :param tuya_id:
         :param host:
         :param port:
+        :param version:
         :return:
         """
-        if fast is None:
-            socket_timeout = .150
-            device_timeout = .250
-        else:
-            socket_timeout = .3
-            device_timeout = .400
+        location = self.device_locations.get(tuya_id, {})
+        if version is None:
+            version = location.get('version', PROTOCOL_VERSION)
+        # Always set a new dictionary, changes inside the existing one wouldn't be persisted.
+        self.device_locations[tuya_id] = {
+            'address': host,
+            'port': port,
+            'version': version,
+            'last_seen': int(time()),
+        }
 
-        the_socket = socket(AF_INET, SOCK_STREAM)
-        the_socket.settimeout(socket_timeout)
+    @inlineCallbacks
+    def check_known_locations(self):
+        """
+        Check all devices at their last known address, all at once. This allows startup to complete
+        in about one device round trip instead of waiting for a network scan.
+
+        :return:
+        """
+        checks = []
+        for record in self.registry:
+            location = self.device_locations.get(record.tuya_id)
+            if location is None:
+                continue
+            checks.append(self.check_known_location(record, location))
+        if len(checks) > 0:
+            yield DeferredList(checks)
+        logger.debug("Tuya devices at their known locations: {count} of {total}",
+                     count=len(checks), total=len(self.registry))
+
+    @inlineCallbacks
+    def check_known_location(self, record, location):
+        """
+        Ask a device for its status at its last known address.
+
+        :param record:
+        :param location:
+        :return:
+        """
+        tuya = record.at(location['address'], location['port'])
         try:
-            the_socket.connect((host, port))
-        except Exception:
+            data = yield protocol.status(tuya, KNOWN_LOCATION_TIMEOUT)
+        except Exception as e:
+            logger.debug("Tuya device {label} not at it's last known address: {e}", label=record.full_label, e=e)
             return
+        if not isinstance(data, dict) or 'dps' not in data or data.get('devId', record.tuya_id) != record.tuya_id:
+            return
+        self.attach_tuya(record, location['address'], location['port'], location['version'])
+        self.current_scan_results.add(record.device_id)
+        status = data['dps']
+        self.status_cache.update(record.tuya_id, status, full=True)
+        self.status_changed(record, status)
+
+    def device_discovered(self, tuya_id, address, version):
+        """
+        Called by the discovery listener when a device is first heard, or it's address changed.
+
+        :param tuya_id:
+        :param address:
+        :param version:
+        :return:
+        """
+        record = self.registry.find(tuya_id)
+        if record is None:
+            logger.debug("Heard an unknown Tuya device: {tuya_id}", tuya_id=tuya_id)
+            return
+        if record.address == address:
+            return
+        logger.info("Found Tuya device {label} at {address}", label=record.full_label, address=address)
+        self.attach_tuya(record, address, version=version)
+        self.fetch_device_status(record, False)
+
+    @inlineCallbacks
+    def scan_for_tuya_devices(self, fast=None):
+        """
+        Finds the Tuya devices that need locating, cheapest checks first:
+
+        #. Devices that have been heard broadcasting, have a connected listener, or recently answered
+           at their known address are used as is.
+        #. The rest are asked for their status at their last known address.
+        #. Hosts in the neighbor table that don't belong to a known device are probed.
+        #. Only then is the network swept. A fast scan sweeps all of it, otherwise the next
+           SWEEP_CHUNK hosts are swept and the following scan continues from there.
+
+        Normally called through self.scan_planner, which debounces requests.
+
+        :param fast: Sweep the whole network at full speed, if a sweep is needed.
+        :return:
+        """
+        if self.scan_running is True:
+            return
+        self.scan_running = True
+        logger.debug("Tuya device scanning started.")
+        self.current_scan_results = set()
+        self.scanner = None
         try:
-            the_socket.shutdown(SHUT_RDWR)
-        except:
-            pass
-        try:
-            the_socket.close()
-        except:
-            pass
-
-        # we have a potential hit.
-        for device_id, device in self._module_devices_cached.items():
-            if device_id in self.current_scan_results:
-                logger.debug("Device has already been matched, skipping. {label}", label=device.full_label)
-                continue
-            time_sleep(device_timeout)
-            device_variables = device.device_variables_cached
-            var_device_id = device_variables['device_id']['values'][0]
-            if var_device_id == '':
-                logger.warn("Device is missing Tuya device_id: {label}", label=device.full_label)
-                continue
-            var_local_key = device_variables['local_key']['values'][0]
-            if var_local_key == '':
-                logger.warn("Device is missing Tuya local_key: {label}", label=device.full_label)
-                continue
+            swept = yield self.locate_devices(fast)
+        finally:
+            self.scan_running = False
+        self.metrics.scan_finished(self.scanner, swept is True)
+        logger.debug("Tuya device scanning finished, {located} of {total} devices located.",
+                     located=len(self.current_scan_results), total=len(self.registry))
+
+    @inlineCallbacks
+    def locate_devices(self, fast=None):
+        """
+        The steps of scan_for_tuya_devices(), see there.
+
+        :param fast:
+        :return: True if the network was swept, False if the earlier steps found every device.
+        """
+        self.build_device_index()
+        known_addresses = self.discovery.addresses()
+        unlocated = []
+        for record in self.registry:
+            details = self.discovery.get(record.tuya_id)  # heard broadcasting from a new address
+            if details is not None and record.address != details['address']:
+                self.attach_tuya(record, details['address'], version=details['version'])
+            if self.is_located(record):
+                self.current_scan_results.add(record.device_id)
+                known_addresses.add(record.address)
+            else:
+                unlocated.append(record)
+        if len(unlocated) == 0:
+            return False
+
+        # Last known addresses.
+        checks = []
+        for record in unlocated:
+            location = self.device_locations.get(record.tuya_id)
+            if location is not None:
+                checks.append(self.check_known_location(record, location))
+        if len(checks) > 0:
+            yield DeferredList(checks)
+        if self.all_located():
+            return False
+
+        # Neighbor table candidates.
+        known_addresses.update(record.address for record in self.registry
+                               if record.device_id in self.current_scan_results)
+        candidates = [host for host in read_neighbor_table(self.get_scan_networks()) if host not in known_addresses]
+        if len(candidates) > 0:
+            self.scanner = NetworkScanner(self.identify_host, protocol.DEFAULT_PORT, timeout=.3)
+            yield self.scanner.scan([], skip=known_addresses, hosts=candidates)
+            known_addresses.update(candidates)
+        if self.all_located():
+            return False
 
-            # logger.info("Testing (start): {host} {device} {key} ", host=host, device=var_device_id, key=var_local_key)
+        # Sweep.
+        if fast is True:
+            self.scanner = NetworkScanner(self.identify_host, protocol.DEFAULT_PORT, timeout=.3,
+                                          initial_concurrency=32, max_concurrency=256)
+            yield self.scanner.scan(self.get_scan_networks(), skip=known_addresses)
+        else:
+            self.scanner = NetworkScanner(self.identify_host, protocol.DEFAULT_PORT, timeout=.150,
+                                          initial_concurrency=1, min_concurrency=1, max_concurrency=16)
+            hosts = self.sweep_cursor.next_hosts(self.get_scan_networks(), SWEEP_CHUNK)
+            yield self.scanner.scan([], skip=known_addresses, hosts=hosts)
+        return True
+
+    def is_located(self, record):
+        """
+        Check if a device's location is known to be current. A device heard in discovery broadcasts
+        is only current once it's been attached at the address it broadcast from.
+
+        :param record:
+        :return: True if the device doesn't need to be looked for.
+        """
+        details = self.discovery.get(record.tuya_id)
+        if details is not None and record.address == details['address']:
+            return True
+        if record.located is False:
+            return False  # never found, or the device_id or local_key was changed
+        listener = self.listeners.get(record.tuya_id)
+        if listener is not None and listener.connected:
+            return True
+        location = self.device_locations.get(record.tuya_id)
+        return location is not None and record.address == location['address'] \
+            and time() - location['last_seen'] < LOCATION_MAX_AGE
+
+    def all_located(self):
+        return len(self.current_scan_results) >= len(self.registry)
+
+    def get_scan_networks(self):
+        """
+        The networks to scan, in CIDR notation. Defaults to the gateway's local network, additional
+        networks (such as other interfaces or VLANs) can be set as a comma separated list in the
+        'scan_networks' option of the 'tuya' config section.
+
+        :return: List of networks.
+        """
+        networks = [get_local_network_info()['ipv4']['cidr']]
+        for network in self._Configs.get("tuya", "scan_networks", "").split(","):
+            network = network.strip()
+            if network != "" and network not in networks:
+                networks.append(network)
+        return networks
+
+    @inlineCallbacks
+    def identify_host(self, host, port):
+        """
+        Called by the scanner for hosts that have the Tuya port open, tries to match it to a Yombo device.
+
+        The status reply includes the devId, so a single probe identifies the device. Only if the
+        device answers without a devId are the remaining devices tried one at a time, starting
+        with the device last found at the host.
+
+        :param host:
+        :param port:
+        :return:
+        """
+        unmatched = [record for record in self.registry if record.device_id not in self.current_scan_results]
+        previous = self.registry.at_address(host)
+        if previous is not None and previous in unmatched:
+            unmatched.remove(previous)
+            unmatched.insert(0, previous)
+        for record in unmatched:
+            # logger.info("Testing (start): {host} {device} {key} ", host=host, device=record.tuya_id, key=record.local_key)
             try:
-                tuya = pytuya.OutletDevice(var_device_id, host, var_local_key)
-                data = tuya.status()
-            except ConnectionResetError as e:
+                tuya = record.at(host, port)
+                data = yield self.identify_retry_policy.run(protocol.status, tuya)  # the probe may still hold the connection
+            except TimeoutError:
+                logger.warn("Tuya device at {host} isn't answering, it appears the Tuya/Jinvoo app might be running.",
+                            host=host)
+                return
+            except protocol.NETWORK_ERRORS as e:
                 logger.debug("Tuya connection reset error: {host}", host=host)
+                return
+            except Exception as e:
+                logger.debug("Unable to decode Tuya reply from {host}: {e}", host=host, e=e)
                 continue
-            except socket.timeout:
-                logger.warn("Tuya refused connection, it appears the Tuya/Jinvoo app might be running:  {host}", host=host)
+            if not isinstance(data, dict) or 'dps' not in data:
                 continue
-            if isinstance(data, dict) and 'dps' in data:
-                self.current_scan_results.append(device_id)
-                status = data['dps']
-                device.tuya = tuya  # store reference to Tuya device for later.
-                device.tuya_address = host
-                device.tuya_id = var_device_id
-                device.tuya_key = var_local_key
-                if device.status != status:
-                    self.set_device_status(device, status)
-                return
+            if 'devId' in data:
+                record = self.registry.find(data['devId'])
+                if record is None:
+                    logger.debug("Found an unknown Tuya device at {host}: {tuya_id}", host=host, tuya_id=data['devId'])
+                    return
+            self.device_located(record, host, data['dps'])
+            return
 
-    @inlineCallbacks
-    def fetch_all_device_status(self, allow_cache=None):
+    def device_located(self, record, host, status):
         """
-        Fetch the status of all known Tuya type devices. This simply iterates through the
-        known list of devices this module manages using the magic variable "self._module_devices_cached".
+        Called when a scan has found where a device lives.
 
-        :param allow_cache:
+        :param record:
+        :param host:
+        :param status: The dps from the device's status reply.
         :return:
         """
-        for device_id, device in self._module_devices_cached.items():
-            self.fetch_device_status(device, allow_cache)
-            yield sleep(0.100)
+        if record.device_id in self.current_scan_results:
+            return
+        self.current_scan_results.add(record.device_id)
+        self.attach_tuya(record, host)
+        self.status_cache.update(record.tuya_id, status, full=True)
+        self.status_changed(record, status)
+        if self.scanner is not None and self.all_located():
+            self.scanner.stop()  # everything has been found, no need to keep scanning
+
+    def fetch_all_device_status(self):
+        """
+        Fetch the status of all located Tuya devices now. The polls share the poller's limit on
+        requests in flight, so this takes longer with more devices but the load stays the same.
+
+        Normally this isn't needed, the poller polls each device on its own schedule.
+
+        :return: Deferred that fires once every device has been polled.
+        """
+        return self.poller.poll_all()
+
+    def poll_device(self, tuya_id):
+        """
+        Called by the poller when a device is due for a poll. Polls always ask the device, the
+        cache would answer almost every poll with the previous poll's values.
+
+        :param tuya_id:
+        :return: Deferred that fires with the status, or None if the device didn't answer.
+        """
+        record = self.registry.find(tuya_id)
+        if record is None or record.located is False:
+            return None
+        d = self.fetch_device_status(record, False)
+        # The poller compares results to spot changes, give it the published values so noise
+        # that wasn't published doesn't count.
+        d.addCallback(lambda status: None if status is None else self.changes.get(tuya_id))
+        return d
 
     @inlineCallbacks
-    def fetch_device_status(self, device, allow_cache=None):
+    def fetch_device_status(self, record, allow_cache=None, priority=None):
         """
-        Fetch the status for a single Yombo device.
+        Fetch the status for a single device. Busy devices are retried with backoff, devices
+        known to be offline fail right away.
 
-        :param device:
+        :param record:
         :param allow_cache:
-        :return:
+        :param priority: Queue priority, defaults to PRIORITY_POLL.
+        :return: The dps dictionary, or None if the device couldn't be reached.
         """
-        start_time = time()
-        received = False
-        while received is False and time() - start_time < 5:
-            try:
-                status = yield self.fetch_remote_status(device, allow_cache)
-                if device.status != status:
-                    self.set_device_status(device, status)
-                received = True
-                return status
-            except ConnectionResetError as e:
-                logger.info("Unable to fetch remote status.")
-                yield sleep(0.150)
-        return None
+        try:
+            status = yield self.fetch_remote_status(record, allow_cache, priority)
+        except protocol.NETWORK_ERRORS as e:
+            logger.info("Unable to fetch remote status for {label}: {e}", label=record.full_label, e=e)
+            return None
+        except DeviceOffline:
+            logger.debug("Not fetching status, {label} is offline.", label=record.full_label)
+            return None
+        except CommandExpired:
+            logger.info("Status request for {label} expired in the queue.", label=record.full_label)
+            return None
+        except Exception as e:
+            logger.warn("Unable to fetch status for {label}: {e}", label=record.full_label, e=e)
+            return None
+        self.status_changed(record, status)
+        return status
 
-    @inlineCallbacks
-    def fetch_remote_status(self, device, allow_cache=None):
+    def fetch_remote_status(self, record, allow_cache=None, priority=None):
         """
-        Fetch the status of a device. This will call do_fetch_remote_status() to get all the ports. It will then
-        update the cache for all the ports on the device. This returns the status of a single port.
+        Fetch the status of a device, this returns the dps values for all the ports.
 
-        This method uses threads to help ensure the system remain async.
+        Recent values are returned from the cache. Older values are returned right away while the
+        cache is refreshed in the background. Concurrent requests for the same device share one fetch.
 
-        :param device:
+        :param record:
         :param allow_cache:
-        :return:
+        :param priority: Queue priority, defaults to PRIORITY_POLL.
+        :return: Deferred that fires with the dps dictionary.
         """
-        hash_id = device.device_id
-        if allow_cache is not False and hash_id in self.status_cache:
-            return self.status_cache[hash_id]
+        return self.status_cache.lookup(record.tuya_id, record, priority, allow_cache=allow_cache)
 
-        results = yield threads.deferToThread(self.do_fetch_remote_status, device)
-        for port_num, port_status in results.items():
-            if isinstance(port_status, bool):
-                self.status_cache[hash_id] = port_status
-        return self.status_cache[hash_id]
+    def fetch_dps(self, record, priority=None):
+        """
+        Fetch the status for the status cache. Busy devices are retried with backoff, devices
+        known to be offline fail right away.
+
+        Callers sharing a fetch share this one call, so a device that doesn't answer counts as one
+        failure however many were waiting for it.
 
-    def do_fetch_remote_status(self, device):
+        :param record:
+        :param priority: Queue priority, defaults to PRIORITY_POLL.
+        :return: Deferred that fires with the dps dictionary.
         """
-        This does the actual network fetch. It will return the status for every port for the current device.
+        return self.breakers.call(record.tuya_id, self.retry_policy.run, self.request_status, record, priority)
 
-        :param device:
-        :return:
+    @inlineCallbacks
+    def request_status(self, record, priority=None):
+        """
+        Ask the device for its status. The request waits its turn in the device's command queue,
+        status requests already waiting are shared instead of sending another.
+
+        :param record:
+        :param priority: Queue priority, defaults to PRIORITY_POLL.
+        :return: The dps dictionary.
         """
-        status = device.tuya.status()  # NOTE this does NOT require a valid key
+        if priority is None:
+            priority = PRIORITY_POLL
+        request = self.metrics.timed('status', record.tuya_id, protocol.status)
+        status = yield self.command_queue.submit(record.tuya_id, request, record.tuya,
+                                                 priority=priority, collapse_key='status',
+                                                 listener=self.listeners.get(record.tuya_id))  # NOTE this does NOT require a valid key
         return status['dps']
 
-    def set_device_status(self, device, status):
+    def status_changed(self, record, dps):
         """
-        Sets the status.
+        Compare dps values from a device against the ones last published, and queue any that
+        changed to be published.
+
+        :param record:
+        :param dps: Dictionary of dps index (string) -> value, all of the device's dps or only some.
+        :return: Dictionary of the dps that changed, empty if nothing did.
+        """
+        changes = self.changes.diff(record.tuya_id, dps)
+        if len(changes) > 0:
+            logger.debug("Status of {label} changed: {changes}", label=record.full_label, changes=changes)
+            self.status_publisher.add(record.device, changes, self.changes.get(record.tuya_id))
+        return changes
+
+    def set_device_status(self, device, changes, status):
+        """
+        Sets the status. Called by the status publisher with the changes collected for a device.
 
         :param device:
-        :param status:
+        :param changes: Dictionary of the dps that changed.
+        :param status: The device's complete dps values.
         :return:
         """
-        return
-        if status == 0:
-            command = self._Commands['off']
-            status = 0
+        kwargs = {}
+        if '1' in changes:
+            kwargs['command'] = self._Commands['on'] if changes['1'] else self._Commands['off']
+        device.set_status(machine_status=1 if status.get('1') else 0,
+                          machine_status_extra={'dps': status},
+                          reported_by=self._FullName,
+                          **kwargs)
+
+    def send_network_command(self, record, status, switch=1):
+        """
+        Set the device to reflect the desired status. True to turn on, false to turn off.
+
+        Writes to the same device that arrive close together are merged into a single SET frame.
+
+        :param record:
+        :param status:
+        :param switch: The switch (dps) to set.
+        :return: Deferred that fires with the device's reply.
+        """
+        return self.write_dps(record, {str(switch): status})
+
+    @inlineCallbacks
+    def toggle(self, record, switch=1):
+        """
+        Flip a switch. The current state comes from the cache, so the device is only asked first
+        when its state is unknown.
+
+        The new state is applied to the cache and published right away, so a second toggle right
+        after the first sees it. If the device doesn't acknowledge the command, it's asked for
+        its real state. If it can't be asked either, the previous state is published again.
+
+        :param record:
+        :param switch: The switch (dps) to toggle.
+        :return: The device's reply, or None if it couldn't be reached.
+        """
+        index = str(switch)
+        current = self.switch_state(record, index)
+        if current is None:
+            status = yield self.fetch_device_status(record, False)
+            if status is None or index not in status:
+                logger.info("Unable to toggle {label}, its state is unknown.", label=record.full_label)
+                return None
+            current = status[index]
+        dps = {index: not current}
+        self.status_cache.update(record.tuya_id, dps)
+        self.status_changed(record, dps)
+        reply = yield self.send_network_command(record, not current, switch)
+        if reply is None or reply.retcode:
+            logger.info("Toggle of {label} wasn't acknowledged, checking its state.", label=record.full_label)
+            self.status_cache.invalidate(record.tuya_id)
+            status = yield self.fetch_device_status(record, False)
+            if status is None:
+                self.status_changed(record, {index: current})  # the cache stays empty, the next toggle asks
+        return reply
+
+    def switch_state(self, record, index):
+        """
+        The cached state of a switch, if it can be trusted. While the device's listener is
+        connected the device pushes every change, so older values are still good.
+
+        :param record:
+        :param index: The dps index (string).
+        :return: The value, None if it's unknown or too old.
+        """
+        listener = self.listeners.get(record.tuya_id)
+        if listener is not None and listener.connected:
+            max_age = self.status_cache.stale_age
         else:
-            command = self._Commands['on']
-            status = 1
+            max_age = TOGGLE_MAX_AGE
+        return self.status_cache.get(record.tuya_id, index, max_age)
 
-        device.set_status(machine_status=status,
-                          command=command,
-                          reported_by=self._FullName)
+    @inlineCallbacks
+    def write_dps(self, record, dps):
+        """
+        Write dps values through the write coalescer, logging any failure. The command is timed
+        before the failure is logged, so failed commands are counted as errors.
+
+        :param record:
+        :param dps: Dictionary of dps index (string) -> value.
+        :return: The device's reply, or None if it couldn't be reached.
+        """
+        write = self.metrics.timed('command', record.tuya_id, self.write_coalescer.write)
+        try:
+            received = yield write(record, dps)
+        except CommandExpired:
+            logger.info("Command for {label} expired in the queue.", label=record.full_label)
+            return None
+        except DeviceOffline:
+            logger.info("Unable to send command, {label} is offline.", label=record.full_label)
+            return None
+        except protocol.NETWORK_ERRORS as e:
+            logger.info("Unable to to send_network_command: (reset error) {e}", e=e)
+            return None
+        except Exception as e:
+            logger.info("Unable to to send_network_command: (other) {e}", e=e)
+            return None
+        return received
 
     @inlineCallbacks
-    def send_network_command(self, device, status):
+    def send_dps(self, record, dps, priority=None):
         """
-        Set the device to reflect the desired status. True to turn on, false to turn off.
+        Send a SET frame with the given dps values. Busy devices are retried with backoff, devices
+        known to be offline fail right away with DeviceOffline.
 
-        :param deivce:
-        :param status:
-        :return:
+        :param record:
+        :param dps: Dictionary of dps index (string) -> value.
+        :param priority: Queue priority, defaults to PRIORITY_USER.
+        :return: The device's reply.
         """
-        start_time = time()
-        received = False
-        while received is False and time() - start_time < 5:
-            try:
-                received = yield threads.deferToThread(self.do_send_network_command, device, status)
-                return received
-            except ConnectionResetError as e:
-                logger.info("Unable to to send_network_command: (reset error) {e}", e=e)
-            except Exception as e:
-                logger.info("Unable to to send_network_command: (other) {e}", e=e)
-            yield sleep(0.15)
-        return None
+        received = yield self.breakers.call(record.tuya_id, self.retry_policy.run, self.submit_dps, record, dps,
+                                            priority)
+        self.poller.activity(record.tuya_id)
+        return received
+
+    def submit_dps(self, record, dps, priority=None):
+        """
+        Queue a single attempt at sending a SET frame.
+
+        :param record:
+        :param dps: Dictionary of dps index (string) -> value.
+        :param priority: Queue priority, defaults to PRIORITY_USER.
+        :return: Deferred that fires with the device's reply.
+        """
+        if priority is None:
+            priority = PRIORITY_USER
+        collapse_key = ('set',) + tuple(sorted(dps))  # a newer write to the same dps replaces this one
+        return self.command_queue.submit(record.tuya_id, self.set_dps, record, dps,
+                                         priority=priority, collapse_key=collapse_key,
+                                         listener=self.listeners.get(record.tuya_id))
+
+    @inlineCallbacks
+    def set_dps(self, record, dps, listener=None):
+        """
+        Send a SET frame, called by the command queue when it's the write's turn. The cache and
+        Yombo are updated here, once for every frame actually sent, from the values in the frame.
+        Callers whose writes were replaced by this one only get its reply, so their older values
+        are never published.
+
+        :param record:
+        :param dps: Dictionary of dps index (string) -> value.
+        :param listener: The device's TuyaListenerFactory, if any.
+        :return: The device's reply.
+        """
+        request = self.metrics.timed('set', record.tuya_id, protocol.set_dps)
+        received = yield request(record.tuya, dps, listener=listener)
+        self.status_cache.update(record.tuya_id, dps)
+        self.status_changed(record, dps)
+        return received
+
+    def send_bulk_command(self, changes, concurrency=None, priority=None):
+        """
+        Set many devices at once, such as for a scene. Devices are written in parallel, up to
+        concurrency at a time, so a large scene takes about one device round trip instead of one
+        per device.
+
+        Changes with a lower priority number are started first. Within the same priority, devices
+        that have been slow to answer are started first so they don't hold up the end of the scene.
 
-    def do_send_network_command(self, device, status):
+        :param changes: List of (device, state) or (device, state, priority). The state is True or
+            False (or 'on' or 'off') for the first switch, or a dictionary of dps index -> value.
+            Several changes to the same device are merged into one write, later values win and the
+            lowest priority number is used.
+        :param concurrency: Devices written at the same time, defaults to BULK_CONCURRENCY.
+        :param priority: Queue priority for all the writes, defaults to PRIORITY_USER.
+        :return: Deferred that fires with a dictionary of Yombo device_id -> dictionary with 'success',
+            'seconds', 'error' and 'reply'.
         """
-        This does the actual network operation.
+        if concurrency is None:
+            concurrency = BULK_CONCURRENCY
+        semaphore = DeferredSemaphore(concurrency)
+        merged = {}  # Yombo device_id -> [order, index, device, dps]
+        for index, change in enumerate(changes):
+            device, state = change[0], change[1]
+            order = change[2] if len(change) > 2 else 0
+            if isinstance(state, dict):
+                dps = {str(dps_index): value for dps_index, value in state.items()}
+            else:
+                dps = {'1': state in (True, 'on')}
+            entry = merged.get(device.device_id)
+            if entry is None:
+                merged[device.device_id] = [order, index, device, dps]
+            else:
+                entry[0] = min(entry[0], order)
+                entry[2] = device
+                entry[3].update(dps)
+
+        entries = []
+        for order, index, device, dps in merged.values():
+            slowness = 0
+            record = self.registry.get(device.device_id)
+            if record is not None:
+                slowness = self.metrics.average(record.tuya_id, 'set') or 0
+            entries.append((order, -slowness, index, device, dps))
+        entries.sort(key=lambda entry: entry[:3])
+
+        results = {}
+        writes = [semaphore.run(self.bulk_write, device, dps, priority, results)
+                  for order, slowness, index, device, dps in entries]
+        d = DeferredList(writes, consumeErrors=True)
+        d.addCallback(lambda ignored: results)
+        return d
+
+    @inlineCallbacks
+    def bulk_write(self, device, dps, priority, results):
+        """
+        Write one device for send_bulk_command(), storing the outcome in results.
 
         :param device:
-        :param port:
+        :param dps: Dictionary of dps index (string) -> value.
+        :param priority: Queue priority.
+        :param results: Dictionary of Yombo device_id -> outcome.
         :return:
         """
-        return device.tuya.set_status(status)
+        started = time()
+        result = results[device.device_id] = {'success': False, 'seconds': None, 'error': None, 'reply': None}
+        record = self.registry.get(device.device_id)
+        if record is None or record.located is False:
+            result['error'] = "Device has not been located on the network."
+            return
+        try:
+            result['reply'] = yield self.metrics.timed('command', record.tuya_id, self.send_dps)(record, dps, priority)
+            result['success'] = True
+        except Exception as e:
+            result['error'] = str(e) or e.__class__.__name__
+        result['seconds'] = time() - started
+
+    def play_effect(self, devices, colours, duration, fps=None, loop=False):
+        """
+        Fade bulbs through a list of colours, all in step. Frames are streamed over each bulb's
+        listener connection, bulbs that aren't connected are skipped.
+
+        :param devices: List of Yombo bulb devices.
+        :param colours: Two or more (r, g, b) tuples to fade through, in order.
+        :param duration: Seconds to take from the first colour to the last.
+        :param fps: Frames per second, defaults to effects.DEFAULT_FPS.
+        :param loop: Repeat until stop_effects() is called.
+        :return: Deferred that fires with a dictionary of Tuya device_id -> frames sent, dropped and
+            failed.
+        """
+        if fps is None:
+            fps = DEFAULT_FPS
+        frames = colour_frames(colour_ramp(colours, max(2, int(duration * fps))))
+        streams = []
+        for device in devices:
+            record = self.registry.get(device.device_id)
+            if record is None or record.located is False:
+                continue
+            listener = self.listeners.get(record.tuya_id)
+            if listener is None or listener.connected is False:
+                logger.info("Skipping effect for Tuya device {label}, it's not connected.", label=device.full_label)
+                continue
+            streams.append(BulbStream(record.tuya, listener))
+
+        def finished(results):
+            for stream in streams:
+                self.status_cache.invalidate(stream.tuya.id)  # dropped frames leave the state unknown
+                self.poller.activity(stream.tuya.id)
+            return results
+
+        return self.effects.play(streams, frames, fps, loop).addCallback(finished)
+
+    def stop_effects(self):
+        """
+        Stop all effects that are playing.
+
+        :return:
+        """
+        self.effects.stop()
+
+    def probe_device(self, tuya_id):
+        """
+        Called by the circuit breakers to check if an offline device is back.
+
+        :param tuya_id:
+        :return: Deferred that fires with the dps dictionary, errbacks if the device is still offline.
+        """
+        record = self.registry.find(tuya_id)
+        if record is None or record.located is False:
+            return None
+        d = self.request_status(record, PRIORITY_POLL)  # not through fetch_dps(), the breaker is still open
+        d.addCallback(self._probe_answered, tuya_id)
+        return d
+
+    def _probe_answered(self, dps, tuya_id):
+        self.status_cache.update(tuya_id, dps, full=True)
+        return dps
+
+    def add_metric_gauges(self):
+        """
+        Register the values that are read when metrics are reported.
+
+        :return:
+        """
+        cache = self.status_cache
+
+        def cache_hit_ratio():
+            lookups = cache.hits + cache.stale_hits + cache.misses
+            return (cache.hits + cache.stale_hits) / lookups if lookups else None
+
+        gauges = (
+            ('tuya_status_cache_hits', 'Status lookups answered from the cache.', lambda: cache.hits),
+            ('tuya_status_cache_stale_hits', 'Status lookups answered from the cache while it was refreshed.',
+             lambda: cache.stale_hits),
+            ('tuya_status_cache_misses', 'Status lookups that waited on the device.', lambda: cache.misses),
+            ('tuya_status_cache_hit_ratio', 'Fraction of status lookups answered from the cache.', cache_hit_ratio),
+            ('tuya_command_queue_depth', 'Requests waiting or running in the device queues.',
+             lambda: sum(self.command_queue.pending(key) for key in list(self.command_queue.queues))),
+            ('tuya_polls_in_flight', 'Status polls running.', lambda: self.poller.in_flight),
+            ('tuya_devices_offline', 'Devices with an open circuit breaker.',
+             lambda: len([key for key in self.breakers.breakers if self.breakers.is_open(key)])),
+            ('tuya_listeners_connected', 'Devices with a connected push listener.',
+             lambda: len([listener for listener in self.listeners.values() if listener.connected])),
+            ('tuya_devices_located', 'Devices with a known address.',
+             self.registry.located),
+        )
+        for name, description, function in gauges:
+            self.metrics.add_gauge(name, description, function)
+
+    def report_metrics(self):
+        """
+        Send the gauges to the statistics library, and write the Prometheus snapshot if the
+        'prometheus_file' option of the 'tuya' config section is set. Point the node_exporter
+        textfile collector at the file's directory to scrape it.
+
+        :return:
+        """
+        self.metrics.publish()
+        path = self._Configs.get("tuya", "prometheus_file", "")
+        if path == "":
+            return
+        temp_path = path + ".tmp"
+        try:
+            with open(temp_path, "w") as metrics_file:
+                metrics_file.write(self.metrics.prometheus())
+            os.replace(temp_path, path)  # the collector never sees a half written file
+        except (IOError, OSError) as e:
+            logger.warn("Unable to write Tuya metrics to {path}: {e}", path=path, e=e)
 
     @inlineCallbacks
     def _device_command_(self, **kwargs):
@@ -353,20 +1034,26 @@ class Tuya(YomboModule):
         request_id = kwargs['request_id']
         logger.debug("Got device command..for me")
 
-        if hasattr(device, 'tuya') is False:
-            logger.warn("Unable to control device: {label}, Tuya is missing from device.", label=device.full_label)
+        record = self.registry.get(device.device_id)
+        if record is None or record.located is False:
+            logger.warn("Unable to control device: {label}, it hasn't been found on the network.",
+                        label=device.full_label)
             return
 
         command = kwargs['command']
         command_label = command.machine_label
-        if command_label == 'on':
-            yield self.send_network_command(device, True)
-        elif command_label == 'off':
-            yield self.send_network_command(device, False)
-        elif command_label == 'toggle':
-            status = self.fetch_device_status(device, False)
-            yield self.send_network_command(device, not status)
-        device.device_command_done(request_id)
+        try:
+            if command_label == 'on':
+                yield self.send_network_command(record, True)
+            elif command_label == 'off':
+                yield self.send_network_command(record, False)
+            elif command_label == 'toggle':
+                yield self.toggle(record)
+        except Exception as e:
+            logger.warn("Unable to send command '{command}' to {label}: {e}",
+                        command=command_label, label=device.full_label, e=e)
+        finally:
+            device.device_command_done(request_id)
 
     # def _webinterface_add_routes_(self, **kwargs):
     #     """